@@ -0,0 +1,57 @@
+"""Compare exact and pyramid seam carving, in time and quality. Quality is
+measured as the mean gradient magnitude of the removed pixels in the input
+image: the lower, the less visible the seams.
+
+Usage: python benchmarks/carve_pyramid.py IMAGE [-r RATIO] [-l LEVELS ...] [-t TOLERANCE ...]
+"""
+import argparse
+import pathlib
+import sys
+import time
+
+import cv2
+import numpy
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+from fftools import carving
+
+
+def gradient(image: numpy.ndarray) -> numpy.ndarray:
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY).astype(numpy.float32)
+    return numpy.abs(cv2.Sobel(gray, -1, 1, 0)) + numpy.abs(cv2.Sobel(gray, -1, 0, 1))
+
+
+def carve(image: numpy.ndarray, count: int, levels: int, tolerance: int) -> tuple[float, numpy.ndarray]:
+    start = time.perf_counter()
+    _, seams = carving.remove_seams(image, count, levels=levels, tolerance=tolerance)
+    return time.perf_counter() - start, seams
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("image", type=pathlib.Path)
+    parser.add_argument("-r", "--ratio", type=float, default=0.2, help="fraction of the width to remove")
+    parser.add_argument("-l", "--levels", type=int, nargs="+", default=[1, 2, 3])
+    parser.add_argument("-t", "--tolerance", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+    image = cv2.imread(args.image.as_posix())
+    if image is None:
+        raise ValueError(f"Could not load {args.image}")
+    count = int(image.shape[1] * args.ratio)
+    carve(image[:32, :64], 8, 1, 1) # compile kernels
+    energy = gradient(image)
+    rows = numpy.arange(image.shape[0])
+    reference_time, seams = carve(image, count, 0, 0)
+    reference = energy[rows, seams].mean()
+    print(f"exact: {reference_time:.2f}s, seam energy {reference:.2f}")
+    for levels in args.levels:
+        for tolerance in args.tolerance:
+            elapsed, seams = carve(image, count, levels, tolerance)
+            quality = energy[rows, seams].mean()
+            print(f"levels={levels} tolerance={tolerance}: {elapsed:.2f}s "
+                  f"(x{reference_time / elapsed:.1f}), seam energy {quality:.2f} "
+                  f"({100 * (quality / reference - 1):+.1f}%)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,498 @@
+"""Compiled kernels for seam carving.
+
+The input image is never modified: the carved image is described by a map
+holding, for each of its pixels, the column of the input image it comes from.
+This map and the energy buffers are allocated once at the size of the input
+image, and only their first `width` columns are used: removing a seam shifts
+the end of each row to the left instead of reallocating anything.
+
+Kernels are declared with explicit signatures, so they are compiled when this
+module is first imported, then loaded from numba's on-disk cache (see the
+`warmup` tool).
+
+@see https://en.m.wikipedia.org/wiki/Seam_carving
+@see https://github.com/andrewdcampbell/seam-carving
+"""
+import numba
+import numpy
+
+
+@numba.njit("void(uint8[:, :, ::1], int32[:, ::1], int64, int64[::1], int64[::1], float64[:, ::1])", parallel=True, cache=True)
+def backward_energy(image, index, width, lo, hi, energy):
+    """Gradient magnitude of a 3-channel image (with wrapping borders), only
+    computed for columns lo[i] to hi[i] (inclusive) of each row i.
+    """
+    h = image.shape[0]
+    for i in numba.prange(h):
+        up = (i - 1) % h
+        down = (i + 1) % h
+        for j in range(lo[i], hi[i] + 1):
+            left = index[i, (j - 1) % width]
+            right = index[i, (j + 1) % width]
+            sx = 0.0
+            sy = 0.0
+            for c in range(3):
+                dx = float(image[i, left, c]) - float(image[i, right, c])
+                dy = float(image[up, index[up, j], c]) - float(image[down, index[down, j], c])
+                sx += dx * dx
+                sy += dy * dy
+            energy[i, j] = numpy.sqrt(sx + sy)
+
+
+@numba.njit("void(float64[:, ::1], int32[:, ::1], int64, int64[::1], int64[::1], float64[:, :, ::1])", parallel=True, cache=True)
+def forward_costs(gray, index, width, lo, hi, costs):
+    """Costs of the three possible seam moves (up, left, right) from the
+    forward energy criterion, only computed for columns lo[i] to hi[i].
+    """
+    h = gray.shape[0]
+    for i in numba.prange(h):
+        up = (i - 1) % h
+        for j in range(lo[i], hi[i] + 1):
+            u = gray[up, index[up, j]]
+            l = gray[i, index[i, (j - 1) % width]]
+            r = gray[i, index[i, (j + 1) % width]]
+            cu = abs(r - l)
+            costs[0, i, j] = cu
+            costs[1, i, j] = abs(u - l) + cu
+            costs[2, i, j] = abs(u - r) + cu
+
+
+@numba.njit("float64(float64[:, ::1], int64, int64, int64[::1], int64[::1])", cache=True)
+def _banded(buffer, i, j, lo, hi):
+    """Value of buffer[i, j], or infinity outside of the band of row i."""
+    if j < lo[i] or j > hi[i]:
+        return numpy.inf
+    return buffer[i, j]
+
+
+@numba.njit("void(float64[:, :, ::1], int64, int64[::1], int64[::1], float64[:, ::1], float64[:, ::1])", parallel=True, cache=True)
+def forward_energy(costs, width, lo, hi, energy, m):
+    """Forward energy algorithm as described in "Improved Seam Carving for
+    Video Retargeting" by Rubinstein, Shamir, Avidan. Each pixel gets the cost
+    of the cheapest move leading to it. Only columns lo[i] to hi[i] of each
+    row i are considered. Rows are processed sequentially, columns within a
+    row in parallel.
+    """
+    h = costs.shape[1]
+    for j in range(lo[0], hi[0] + 1):
+        m[0, j] = 0
+        energy[0, j] = 0
+    for i in range(1, h):
+        for j in numba.prange(lo[i], hi[i] + 1):
+            mu = _banded(m, i - 1, j, lo, hi) + costs[0, i, j]
+            ml = _banded(m, i - 1, (j - 1) % width, lo, hi) + costs[1, i, j]
+            mr = _banded(m, i - 1, (j + 1) % width, lo, hi) + costs[2, i, j]
+            if mu <= ml and mu <= mr:
+                m[i, j] = mu
+                energy[i, j] = costs[0, i, j]
+            elif ml <= mr:
+                m[i, j] = ml
+                energy[i, j] = costs[1, i, j]
+            else:
+                m[i, j] = mr
+                energy[i, j] = costs[2, i, j]
+
+
+@numba.njit("void(float64[:, ::1], int64, int64[::1], int64[::1], float64[:, ::1], int64[:, ::1], int64[::1])", parallel=True, cache=True)
+def compute_shortest_path(energy, width, lo, hi, M, backtrack, seam):
+    """DP algorithm for finding the seam of minimum energy, only going through
+    columns lo[i] to hi[i] of each row i. Rows are processed sequentially,
+    columns within a row in parallel. Ties are broken towards the left. If no
+    seam fits in the band, the cumulative energy of the returned seam is
+    infinite. Code adapted from
+    https://karthikkaranth.me/blog/implementing-seam-carving-with-python/
+    """
+    h = energy.shape[0]
+    for j in range(lo[0], hi[0] + 1):
+        M[0, j] = energy[0, j]
+    for i in range(1, h):
+        for j in numba.prange(lo[i], hi[i] + 1):
+            argmin = max(j - 1, 0)
+            for l in range(argmin + 1, min(j + 2, width)):
+                if _banded(M, i - 1, l, lo, hi) < _banded(M, i - 1, argmin, lo, hi):
+                    argmin = l
+            backtrack[i, j] = argmin
+            M[i, j] = energy[i, j] + _banded(M, i - 1, argmin, lo, hi)
+    col = lo[h - 1]
+    for l in range(lo[h - 1] + 1, hi[h - 1] + 1):
+        if M[h - 1, l] < M[h - 1, col]:
+            col = l
+    for i in range(h - 1, -1, -1):
+        seam[i] = col
+        col = backtrack[i, col]
+
+
+@numba.njit("int64(float64[:, ::1], int64, int64, float64, boolean[:, ::1], int64[:, ::1])", cache=True)
+def extract_seams(M, width, count, threshold, blocked, seams):
+    """Extract up to `count` disjoint and non-crossing seams from a single
+    cumulative energy map `M`, and return how many were found. Seams start
+    from the cheapest bottom pixels, as long as their cumulative energy is at
+    most `threshold`, and are backtracked greedily through the cheapest
+    neighbor that no previous seam blocks. Seams whose backtracking gets stuck
+    are dropped. Found seams are written to `seams` in the coordinates they
+    have once the previous ones are removed, ie. ready for sequential removal.
+    """
+    h = M.shape[0]
+    blocked[:, :width] = False
+    found = 0
+    for c in numpy.argsort(M[h - 1, :width], kind="mergesort"):
+        if found == count or M[h - 1, c] > threshold:
+            break
+        if blocked[h - 1, c]:
+            continue
+        seams[found, h - 1] = c
+        stuck = False
+        for i in range(h - 1, 0, -1):
+            j = seams[found, i]
+            best = -1
+            for l in range(max(j - 1, 0), min(j + 2, width)):
+                if blocked[i - 1, l] or (l != j and blocked[i, l] and blocked[i - 1, j]):
+                    continue
+                if best < 0 or M[i - 1, l] < M[i - 1, best]:
+                    best = l
+            if best < 0:
+                stuck = True
+                break
+            seams[found, i - 1] = best
+        if stuck:
+            continue
+        for i in range(h):
+            blocked[i, seams[found, i]] = True
+        found += 1
+    for i in range(h):
+        for t in range(found - 1, 0, -1):
+            shift = 0
+            for u in range(t):
+                if seams[u, i] < seams[t, i]:
+                    shift += 1
+            seams[t, i] -= shift
+    return found
+
+
+@numba.njit([
+    "void(int32[:, ::1], int64[::1], int64)",
+    "void(float64[:, ::1], int64[::1], int64)",
+    ], parallel=True, cache=True)
+def remove_seam(buffer, seam, width):
+    """Remove a vertical seam from a 2D buffer, in place."""
+    for i in numba.prange(buffer.shape[0]):
+        for j in range(seam[i], width - 1):
+            buffer[i, j] = buffer[i, j + 1]
+
+
+@numba.njit("void(int64[::1], int64, int64[::1], int64[::1])", cache=True)
+def seam_band(seam, width, lo, hi):
+    """Columns of each row whose energy may change after removing `seam`, ie.
+    those next to the seam in this row or the adjacent ones. Energy wraps
+    around borders, so both ends of the rows are always included (they are
+    handled by the caller).
+    """
+    h = seam.shape[0]
+    for i in range(h):
+        a = min(seam[(i - 1) % h], seam[i], seam[(i + 1) % h])
+        b = max(seam[(i - 1) % h], seam[i], seam[(i + 1) % h])
+        lo[i] = max(0, a - 2)
+        hi[i] = min(width - 1, b + 1)
+
+
+@numba.njit("void(uint8[:, :, ::1], int32[:, ::1], int64, uint8[:, :, ::1])", parallel=True, cache=True)
+def gather(image, index, width, out):
+    for i in numba.prange(image.shape[0]):
+        for j in range(width):
+            for c in range(image.shape[2]):
+                out[i, j, c] = image[i, index[i, j], c]
+
+
+@numba.njit([
+    "void(uint8[:, :, ::1], int64[:, ::1], uint8[:, :, ::1])",
+    "void(uint32[:, :, ::1], int64[:, ::1], uint32[:, :, ::1])",
+    ], parallel=True, cache=True)
+def insert_seams(image, seams, out):
+    """Widen an image with all the seams at once. `seams` has shape (k, h) and
+    holds columns of the input image, before each of which a pixel averaging
+    it with its left neighbor (right one for the first column) is inserted.
+    """
+    k, h = seams.shape
+    w = image.shape[1]
+    for i in numba.prange(h):
+        cols = numpy.sort(seams[:, i])
+        s = 0
+        o = 0
+        for c in range(w):
+            while s < k and cols[s] == c:
+                a = c - 1 if c > 0 else min(c + 1, w - 1)
+                for ch in range(image.shape[2]):
+                    out[i, o, ch] = (numpy.int32(image[i, a, ch]) + numpy.int32(image[i, c, ch])) // 2
+                o += 1
+                s += 1
+            for ch in range(image.shape[2]):
+                out[i, o, ch] = image[i, c, ch]
+            o += 1
+
+
+def widen(image: numpy.ndarray, seams: numpy.ndarray) -> numpy.ndarray:
+    """Insert seams given as columns of `image` (see `Carver.remove_seam`)."""
+    if image.ndim == 2:
+        return widen(image[:, :, numpy.newaxis], seams)[:, :, 0]
+    h, w, depth = image.shape
+    out = numpy.empty((h, w + seams.shape[0], depth), dtype=image.dtype)
+    insert_seams(numpy.ascontiguousarray(image), numpy.ascontiguousarray(seams, dtype=numpy.int64), out)
+    return out
+
+
+class Carver:
+    """Removes vertical seams from an 8-bit BGR image. Energy is kept up to
+    date as seams are removed: with backward energy, only the band of columns
+    next to each removed seam is recomputed. With forward energy, the same
+    goes for the move costs, but the energy itself results from a DP over the
+    whole image and has to be recomputed.
+    """
+
+    def __init__(self, image: numpy.ndarray, use_forward_energy: bool = True):
+        h, w = image.shape[:2]
+        self.use_forward_energy = use_forward_energy
+        self.index = numpy.empty((h, w), dtype=numpy.int32)
+        self.lo = numpy.zeros(h, dtype=numpy.int64)
+        self.hi = numpy.zeros(h, dtype=numpy.int64)
+        self.energy = numpy.zeros((h, w))
+        self.M = numpy.zeros((h, w))
+        self.backtrack = numpy.zeros((h, w), dtype=numpy.int64)
+        self.seam = numpy.zeros(h, dtype=numpy.int64)
+        self.blocked = None
+        self.rows = numpy.arange(h)
+        if self.use_forward_energy:
+            self.gray = numpy.zeros((h, w))
+            self.costs = numpy.zeros((3, h, w))
+            self.m = numpy.zeros((h, w))
+        self.load(image)
+
+    def load(self, image: numpy.ndarray):
+        """Start carving another image of the same size, reusing the buffers
+        of the previous one.
+        """
+        import cv2
+        h, w = self.index.shape
+        if image.shape[:2] != (h, w):
+            raise ValueError(f"Image shape {image.shape[:2]} does not match {(h, w)}")
+        self.image = numpy.ascontiguousarray(image, dtype=numpy.uint8)
+        self.width = w
+        self.index[:] = numpy.arange(w, dtype=numpy.int32)
+        self.lo[:] = 0
+        self.hi[:] = w - 1
+        if self.use_forward_energy:
+            self.gray[:] = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+        self._update(self.lo, self.hi)
+
+    def _update(self, lo: numpy.ndarray, hi: numpy.ndarray):
+        if self.use_forward_energy:
+            forward_costs(self.gray, self.index, self.width, lo, hi, self.costs)
+        else:
+            backward_energy(self.image, self.index, self.width, lo, hi, self.energy)
+
+    def minimum_seam(self, lo: numpy.ndarray | None = None, hi: numpy.ndarray | None = None) -> numpy.ndarray | None:
+        """Return the column of the seam of minimum energy in each row of the
+        current image. The search can be restricted to columns lo[i] to hi[i]
+        of each row i, in which case None is returned if no seam fits.
+        """
+        h = self.image.shape[0]
+        if lo is None or hi is None:
+            lo = numpy.zeros(h, dtype=numpy.int64)
+            hi = numpy.full(h, self.width - 1, dtype=numpy.int64)
+        if self.use_forward_energy:
+            forward_energy(self.costs, self.width, lo, hi, self.energy, self.m)
+        compute_shortest_path(self.energy, self.width, lo, hi, self.M, self.backtrack, self.seam)
+        if not numpy.isfinite(self.M[h - 1, self.seam[h - 1]]):
+            return None
+        return self.seam.copy()
+
+    def minimum_seams(self, count: int, spread: float | None = None) -> numpy.ndarray:
+        """Return up to `count` seams of low energy from a single evaluation
+        of the cumulative energy, with shape (k, h). They must be removed in
+        order. The first one is the seam of minimum energy. With `spread`,
+        only seams whose cumulative energy is within `spread` standard
+        deviations (over the bottom row) of the minimum are returned.
+        """
+        h = self.image.shape[0]
+        if count <= 1 and spread is None:
+            return self.minimum_seam()[numpy.newaxis]
+        if self.blocked is None:
+            self.blocked = numpy.zeros(self.M.shape, dtype=numpy.bool_)
+        lo = numpy.zeros(h, dtype=numpy.int64)
+        hi = numpy.full(h, self.width - 1, dtype=numpy.int64)
+        if self.use_forward_energy:
+            forward_energy(self.costs, self.width, lo, hi, self.energy, self.m)
+        compute_shortest_path(self.energy, self.width, lo, hi, self.M, self.backtrack, self.seam)
+        bottom = self.M[h - 1, :self.width]
+        threshold = numpy.inf if spread is None else bottom.min() + spread * bottom.std()
+        seams = numpy.empty((max(1, count), h), dtype=numpy.int64)
+        found = extract_seams(self.M, self.width, count, threshold, self.blocked, seams)
+        return seams[:found]
+
+    def remove_seam(self, seam: numpy.ndarray) -> numpy.ndarray:
+        """Remove a seam from the current image and return the columns it
+        occupies in the input image.
+        """
+        original = self.index[self.rows, seam].astype(numpy.int64)
+        remove_seam(self.index, seam, self.width)
+        if self.use_forward_energy:
+            for k in range(3):
+                remove_seam(self.costs[k], seam, self.width)
+        else:
+            remove_seam(self.energy, seam, self.width)
+        self.width -= 1
+        seam_band(seam, self.width, self.lo, self.hi)
+        self._update(self.lo, self.hi)
+        for j in [0, self.width - 1]:
+            column = numpy.full(len(seam), j, dtype=numpy.int64)
+            self._update(column, column)
+        return original
+
+    def materialize(self) -> numpy.ndarray:
+        out = numpy.empty((self.image.shape[0], self.width, 3), dtype=numpy.uint8)
+        gather(self.image, self.index, self.width, out)
+        return out
+
+
+def remove_seams(
+        image: numpy.ndarray,
+        count: int,
+        use_forward_energy: bool = True,
+        levels: int = 0,
+        tolerance: int = 2,
+        batch: int = 1,
+        callback=None
+        ) -> tuple[Carver, numpy.ndarray]:
+    """Remove `count` vertical seams from an image. Return the carver holding
+    the carved image, and the removed seams as columns of the input image,
+    with shape (count, h). `callback` is called after each seam.
+
+    With `levels` > 0, seams are first searched in a copy of the image
+    downscaled by 2 ** levels. Each of them is projected to full resolution,
+    where as many seams as the scale factor are then searched in a band of
+    `tolerance` downscaled pixels on both sides of the projection. Smaller
+    tolerances are faster but further from the exact result.
+
+    Otherwise, `batch` seams are extracted from each evaluation of the
+    cumulative energy (see `Carver.minimum_seams`) instead of one. With
+    `batch` = 0, their number adapts to the image: seams are taken as long as
+    their energy is within a quarter of a standard deviation of the minimum
+    one, up to an eighth of the width at once.
+    """
+    import cv2
+    h, w = image.shape[:2]
+    carver = Carver(image, use_forward_energy)
+    seams = numpy.empty((count, h), dtype=numpy.int64)
+    scale = 2 ** levels
+    small = None
+    if levels > 0 and w // scale >= 2 and h // scale >= 2:
+        small = Carver(cv2.resize(image, (w // scale, h // scale), interpolation=cv2.INTER_AREA), use_forward_energy)
+        rows = numpy.minimum(numpy.arange(h) * (h // scale) // h, h // scale - 1)
+    lo = numpy.zeros(h, dtype=numpy.int64)
+    hi = numpy.zeros(h, dtype=numpy.int64)
+    k = 0
+
+    def take(seam):
+        nonlocal k
+        seams[k] = carver.remove_seam(seam)
+        k += 1
+        if callback is not None:
+            callback()
+
+    while k < count:
+        if small is not None and small.width > 1:
+            ratio = carver.width / small.width
+            guide = small.minimum_seam()
+            small.remove_seam(guide)
+            center = (guide[rows] + 0.5) * ratio
+            radius = max(1, tolerance) * ratio
+            lo[:] = numpy.floor(center - radius)
+            hi[:] = numpy.ceil(center + radius)
+            for _ in range(min(count - k, max(1, round(ratio)))):
+                numpy.clip(lo, 0, carver.width - 1, out=lo)
+                numpy.clip(hi, 0, carver.width - 1, out=hi)
+                seam = carver.minimum_seam(lo, hi)
+                take(seam if seam is not None else carver.minimum_seam())
+        elif batch == 1:
+            take(carver.minimum_seam())
+        elif batch > 1:
+            for seam in carver.minimum_seams(min(batch, count - k)):
+                take(seam)
+        else:
+            for seam in carver.minimum_seams(min(count - k, max(1, carver.width // 8)), spread=0.25):
+                take(seam)
+    return carver, seams
+
+
+class SeamTracker:
+    """Removes the same number of vertical seams from consecutive frames of a
+    video. Seams of the first frame are exact. In the next frames, each seam
+    is searched within `radius` columns of the matching seam of the previous
+    frame, which keeps seams stable over time and makes the DP cost
+    proportional to the band width instead of the frame width. Buffers are
+    reused from one frame to the next.
+    """
+
+    def __init__(self, count: int, use_forward_energy: bool = True, radius: int = 8):
+        self.count = count
+        self.use_forward_energy = use_forward_energy
+        self.radius = max(1, radius)
+        self.carver: Carver | None = None
+        self.previous: numpy.ndarray | None = None
+
+    def remove_seams(self, frame: numpy.ndarray) -> tuple[Carver, numpy.ndarray]:
+        """Same as the module-level `remove_seams`, for the next frame."""
+        h = frame.shape[0]
+        if self.carver is None:
+            self.carver = Carver(frame, self.use_forward_energy)
+        else:
+            self.carver.load(frame)
+        carver = self.carver
+        tracking = self.previous is not None
+        if self.previous is None:
+            self.previous = numpy.empty((self.count, h), dtype=numpy.int64)
+        lo = numpy.empty(h, dtype=numpy.int64)
+        hi = numpy.empty(h, dtype=numpy.int64)
+        seams = numpy.empty((self.count, h), dtype=numpy.int64)
+        for k in range(self.count):
+            seam = None
+            if tracking:
+                numpy.clip(self.previous[k] - self.radius, 0, carver.width - 1, out=lo)
+                numpy.clip(self.previous[k] + self.radius, 0, carver.width - 1, out=hi)
+                seam = carver.minimum_seam(lo, hi)
+            if seam is None:
+                seam = carver.minimum_seam()
+            self.previous[k] = seam
+            seams[k] = carver.remove_seam(seam)
+        return carver, seams
+
+
+def seam_order(image: numpy.ndarray, use_forward_energy: bool = True, callback=None) -> numpy.ndarray:
+    """Removal order of every pixel of an image when removing vertical seams
+    until a single column remains: pixels of the k-th removed seam get k, and
+    the remaining ones get w - 1. `callback` is called after each seam.
+    """
+    h, w = image.shape[:2]
+    order = numpy.full((h, w), w - 1, dtype=numpy.uint32)
+    carver = Carver(image, use_forward_energy)
+    rows = numpy.arange(h)
+    for k in range(w - 1):
+        order[rows, carver.remove_seam(carver.minimum_seam())] = k
+        if callback is not None:
+            callback()
+    return order
+
+
+def retarget(order: numpy.ndarray, width: int, *arrays: numpy.ndarray) -> list[numpy.ndarray]:
+    """Resize the rows of arrays of shape (h, w, ...) to `width` from a map of
+    removal orders: the first removed pixels of each row are dropped, or
+    duplicated when enlarging. The map does not have to hold a permutation of
+    each row, in which case only ranks matter.
+    """
+    h, w = order.shape
+    ranks = numpy.argsort(order, axis=1, kind="stable")
+    if width <= w:
+        keep = numpy.ones((h, w), dtype=numpy.bool_)
+        keep[numpy.arange(h)[:, numpy.newaxis], ranks[:, :w - width]] = False
+        return [array[keep].reshape(h, width, *array.shape[2:]) for array in arrays]
+    seams = numpy.ascontiguousarray(ranks[:, :width - w].T)
+    return [widen(array, seams) for array in arrays]
@@ -0,0 +1,237 @@
+"""Perceptual hashes of frames, and an index to search them by Hamming
+distance.
+
+Hashes are 64-bit integers, stored in uint64 arrays. Searching uses
+multi-index hashing: hashes are split in `CHUNKS` chunks of 16 bits, and two
+hashes within distance r have at least one chunk within distance r // CHUNKS
+of each other (pigeonhole principle). Each chunk is sorted once, so
+candidates are found by looking up the few chunk values close to the query's
+in a table of offsets, and only those are compared with the query.
+
+@see https://www.hackerfactor.com/blog/index.php?/archives/529-Kind-of-Like-That.html
+@see https://www.cs.toronto.edu/~norouzi/research/papers/multi_index_hashing.pdf
+"""
+import functools
+import itertools
+import pathlib
+
+import cv2
+import numpy
+
+
+CHUNKS = 4
+CHUNK_BITS = 16
+
+POPCOUNT = numpy.array([bin(i).count("1") for i in range(256)], dtype=numpy.uint8)
+
+
+def popcount(x: numpy.ndarray) -> numpy.ndarray:
+    """Number of bits set in each element of a uint64 array."""
+    x = numpy.ascontiguousarray(x, dtype=numpy.uint64)
+    if hasattr(numpy, "bitwise_count"): # numpy >= 2.0
+        return numpy.bitwise_count(x).astype(numpy.int64)
+    return POPCOUNT[x.view(numpy.uint8).reshape(*x.shape, 8)].sum(axis=-1, dtype=numpy.int64)
+
+
+def pack(bits: numpy.ndarray) -> int:
+    """Integer whose bits are the 64 given booleans."""
+    return int.from_bytes(numpy.packbits(bits.ravel()).tobytes(), "big")
+
+
+def dhash(gray: numpy.ndarray) -> int:
+    """Difference hash: whether each pixel of the frame downscaled to 9x8 is
+    brighter than its left neighbour.
+    """
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA).astype(numpy.int16)
+    return pack(small[:, 1:] > small[:, :-1])
+
+
+def phash(gray: numpy.ndarray) -> int:
+    """DCT hash: whether each of the 8x8 lowest frequencies of the frame
+    downscaled to 32x32 is above their median (DC excluded).
+    """
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(numpy.float32)
+    low = cv2.dct(small)[:8, :8]
+    return pack(low > numpy.median(low.ravel()[1:]))
+
+
+HASH_FUNCTIONS = {
+    "dhash": dhash,
+    "phash": phash,
+}
+
+
+@functools.lru_cache(maxsize=8)
+def chunk_neighbours(radius: int) -> numpy.ndarray:
+    """Masks of all chunk values within `radius` bits of 0."""
+    masks = [0]
+    for r in range(1, radius + 1):
+        for bits in itertools.combinations(range(CHUNK_BITS), r):
+            masks.append(sum(1 << b for b in bits))
+    return numpy.array(masks, dtype=numpy.uint16)
+
+
+class HashIndex:
+    """Multi-index over an array of hashes, for radius searches."""
+
+    def __init__(self, hashes: numpy.ndarray):
+        self.hashes = numpy.ascontiguousarray(hashes, dtype=numpy.uint64)
+        self.orders = []
+        self.buckets = []
+        for k in range(CHUNKS):
+            chunk = ((self.hashes >> numpy.uint64(k * CHUNK_BITS)) & numpy.uint64(0xFFFF)).astype(numpy.uint16)
+            order = numpy.argsort(chunk, kind="stable")
+            self.orders.append(order)
+            # Hashes whose chunk is v are orders[k][buckets[k][v]:buckets[k][v + 1]]
+            self.buckets.append(numpy.searchsorted(chunk[order], numpy.arange((1 << CHUNK_BITS) + 1), side="left"))
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def search(self, query: int, radius: int) -> tuple[numpy.ndarray, numpy.ndarray]:
+        """Indices of the hashes within `radius` of `query`, and their
+        distances to it.
+        """
+        masks = chunk_neighbours(radius // CHUNKS)
+        candidates = []
+        for k in range(CHUNKS):
+            values = (numpy.uint16((query >> (k * CHUNK_BITS)) & 0xFFFF) ^ masks).astype(numpy.intp)
+            lo = self.buckets[k][values]
+            hi = self.buckets[k][values + 1]
+            lengths = hi - lo
+            # Concatenate the ranges lo[i]:hi[i] of the sorted chunk
+            starts = numpy.repeat(lo - numpy.cumsum(lengths) + lengths, lengths)
+            candidates.append(self.orders[k][starts + numpy.arange(len(starts))])
+        ids = numpy.unique(numpy.concatenate(candidates))
+        distances = popcount(self.hashes[ids] ^ numpy.uint64(query))
+        keep = distances <= radius
+        return ids[keep], distances[keep]
+
+    def pairs(self, radius: int, block: int = 1 << 13) -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+        """All pairs of indices i < j of hashes within `radius` of each
+        other, and their distances. Identical hashes are searched once, and
+        chunk lookups are run for blocks of `block` hashes at once.
+        """
+        unique, inverse = numpy.unique(self.hashes, return_inverse=True)
+        inverse = inverse.ravel()
+        index = self if len(unique) == len(self.hashes) else HashIndex(unique)
+        masks = chunk_neighbours(radius // CHUNKS)
+        codes = []
+        for k in range(CHUNKS):
+            chunk = ((unique >> numpy.uint64(k * CHUNK_BITS)) & numpy.uint64(0xFFFF)).astype(numpy.uint16)
+            for start in range(0, len(unique), block):
+                queries = numpy.arange(start, min(start + block, len(unique)))
+                values = (chunk[queries, numpy.newaxis] ^ masks).ravel().astype(numpy.intp)
+                lo = index.buckets[k][values]
+                hi = index.buckets[k][values + 1]
+                lengths = hi - lo
+                starts = numpy.repeat(lo - numpy.cumsum(lengths) + lengths, lengths)
+                matches = index.orders[k][starts + numpy.arange(len(starts))]
+                owners = numpy.repeat(numpy.repeat(queries, len(masks)), lengths)
+                keep = matches > owners
+                owners, matches = owners[keep], matches[keep]
+                keep = popcount(unique[owners] ^ unique[matches]) <= radius
+                codes.append(owners[keep] * len(unique) + matches[keep])
+        # Pairs are found once per chunk they are close in
+        codes = numpy.unique(numpy.concatenate(codes + [numpy.empty(0, dtype=numpy.int64)]))
+        # Identical hashes are pairs of distance 0
+        p = numpy.concatenate([codes // len(unique), numpy.arange(len(unique))])
+        q = numpy.concatenate([codes % len(unique), numpy.arange(len(unique))])
+        distances = popcount(unique[p] ^ unique[q])
+        # Expand pairs of unique hashes to all pairs of their occurrences
+        entries = numpy.argsort(inverse, kind="stable")
+        counts = numpy.bincount(inverse, minlength=len(unique))
+        offsets = numpy.cumsum(counts) - counts
+        sizes = counts[p] * counts[q]
+        pair = numpy.repeat(numpy.arange(len(p)), sizes)
+        local = numpy.arange(sizes.sum()) - numpy.repeat(numpy.cumsum(sizes) - sizes, sizes)
+        a = local // counts[q][pair]
+        b = local % counts[q][pair]
+        i = entries[offsets[p][pair] + a]
+        j = entries[offsets[q][pair] + b]
+        keep = (p[pair] != q[pair]) | (a < b)
+        i, j, distances = i[keep], j[keep], distances[pair][keep]
+        return numpy.minimum(i, j), numpy.maximum(i, j), distances
+
+
+class HashLibrary:
+    """Hashes of sampled frames of media files, stored on disk. Each file is
+    identified by its fingerprint, so that only new or modified files need
+    to be hashed again.
+    """
+
+    def __init__(self, method: str = "dhash"):
+        self.method = method
+        self.files: dict[str, tuple[str, numpy.ndarray, numpy.ndarray]] = {}
+        self._index: tuple[HashIndex, numpy.ndarray, numpy.ndarray] | None = None
+
+    @classmethod
+    def load(cls, path: pathlib.Path, method: str = "dhash") -> "HashLibrary":
+        """Load a library from disk, or start an empty one if the file is
+        missing or was built with another hash method.
+        """
+        library = cls(method)
+        if not path.exists():
+            return library
+        with numpy.load(path) as data:
+            if str(data["method"]) != method:
+                return library
+            # Each access to an array of the archive decompresses it again
+            paths, fingerprints = data["paths"], data["fingerprints"]
+            bounds = numpy.cumsum(data["counts"])[:-1]
+            frames, hashes = data["frames"], data["hashes"]
+        for file, fingerprint, file_frames, file_hashes in zip(paths, fingerprints, numpy.split(frames, bounds), numpy.split(hashes, bounds)):
+            library.files[str(file)] = (str(fingerprint), file_frames, file_hashes)
+        return library
+
+    def save(self, path: pathlib.Path):
+        files = list(self.files)
+        numpy.savez_compressed(path,
+            method=self.method,
+            paths=numpy.array(files, dtype=str),
+            fingerprints=numpy.array([self.files[f][0] for f in files], dtype=str),
+            counts=numpy.array([len(self.files[f][1]) for f in files], dtype=numpy.int64),
+            frames=numpy.concatenate([self.files[f][1] for f in files] or [numpy.empty(0, dtype=numpy.int64)]),
+            hashes=numpy.concatenate([self.files[f][2] for f in files] or [numpy.empty(0, dtype=numpy.uint64)]))
+
+    def is_current(self, file: str, fingerprint: str) -> bool:
+        return file in self.files and self.files[file][0] == fingerprint
+
+    def add(self, file: str, fingerprint: str, frames: numpy.ndarray, hashes: numpy.ndarray):
+        self.files[file] = (fingerprint, numpy.asarray(frames, dtype=numpy.int64), numpy.asarray(hashes, dtype=numpy.uint64))
+        self._index = None
+
+    def remove(self, file: str):
+        self.files.pop(file, None)
+        self._index = None
+
+    def index(self) -> tuple[HashIndex, numpy.ndarray, numpy.ndarray]:
+        """Index over all hashes, with the file number and frame of each."""
+        if self._index is None:
+            files = list(self.files.values())
+            hashes = numpy.concatenate([h for _, _, h in files] or [numpy.empty(0, dtype=numpy.uint64)])
+            frames = numpy.concatenate([f for _, f, _ in files] or [numpy.empty(0, dtype=numpy.int64)])
+            owners = numpy.repeat(numpy.arange(len(files)), [len(h) for _, _, h in files]).astype(numpy.int64)
+            self._index = (HashIndex(hashes), owners, frames)
+        return self._index
+
+    def search(self, query: int, radius: int) -> list[tuple[int, str, int]]:
+        """Distance, file and frame of the hashes within `radius` of
+        `query`, closest first.
+        """
+        index, owners, frames = self.index()
+        files = list(self.files)
+        ids, distances = index.search(query, radius)
+        return sorted((int(d), files[owners[i]], int(frames[i])) for i, d in zip(ids, distances))
+
+    def duplicates(self, radius: int) -> list[tuple[int, str, int, str, int]]:
+        """Pairs of frames from different files within `radius` of each
+        other, closest first, as (distance, file, frame, file, frame).
+        """
+        index, owners, frames = self.index()
+        files = list(self.files)
+        i, j, distances = index.pairs(radius)
+        keep = owners[i] != owners[j]
+        return sorted(
+            (int(d), files[owners[a]], int(frames[a]), files[owners[b]], int(frames[b]))
+            for a, b, d in zip(i[keep], j[keep], distances[keep]))
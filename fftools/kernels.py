@@ -0,0 +1,199 @@
+"""Compiled kernels for blending stacks of 8-bit frames.
+
+Stacks are given as 2D arrays of shape (n, size), ie. one flattened frame per
+row, and are reduced along the first axis directly into a preallocated uint8
+array of shape (size,). Pixels are processed by blocks small enough to keep
+their accumulators in cache, and blocks are distributed across threads.
+Arithmetic saturates to [0, 255] instead of wrapping around.
+"""
+import numba
+import numpy
+
+
+BLOCK_SIZE = 4096
+
+
+@numba.njit(parallel=True, cache=True)
+def reduce_average(stack, out):
+    n, size = stack.shape
+    nblocks = (size + BLOCK_SIZE - 1) // BLOCK_SIZE
+    for b in numba.prange(nblocks):
+        start = b * BLOCK_SIZE
+        end = min(size, start + BLOCK_SIZE)
+        acc = numpy.zeros(end - start, dtype=numpy.int32)
+        for i in range(n):
+            for p in range(start, end):
+                acc[p - start] += stack[i, p]
+        for p in range(start, end):
+            out[p] = acc[p - start] // n
+
+
+@numba.njit(parallel=True, cache=True)
+def reduce_brighter(stack, out):
+    n, size = stack.shape
+    nblocks = (size + BLOCK_SIZE - 1) // BLOCK_SIZE
+    for b in numba.prange(nblocks):
+        start = b * BLOCK_SIZE
+        end = min(size, start + BLOCK_SIZE)
+        for p in range(start, end):
+            out[p] = stack[0, p]
+        for i in range(1, n):
+            for p in range(start, end):
+                if stack[i, p] > out[p]:
+                    out[p] = stack[i, p]
+
+
+@numba.njit(parallel=True, cache=True)
+def reduce_darker(stack, out):
+    n, size = stack.shape
+    nblocks = (size + BLOCK_SIZE - 1) // BLOCK_SIZE
+    for b in numba.prange(nblocks):
+        start = b * BLOCK_SIZE
+        end = min(size, start + BLOCK_SIZE)
+        for p in range(start, end):
+            out[p] = stack[0, p]
+        for i in range(1, n):
+            for p in range(start, end):
+                if stack[i, p] < out[p]:
+                    out[p] = stack[i, p]
+
+
+@numba.njit(parallel=True, cache=True)
+def reduce_sum(stack, out):
+    n, size = stack.shape
+    nblocks = (size + BLOCK_SIZE - 1) // BLOCK_SIZE
+    for b in numba.prange(nblocks):
+        start = b * BLOCK_SIZE
+        end = min(size, start + BLOCK_SIZE)
+        acc = numpy.zeros(end - start, dtype=numpy.int32)
+        for i in range(n):
+            for p in range(start, end):
+                acc[p - start] += stack[i, p]
+        for p in range(start, end):
+            out[p] = min(acc[p - start], 255)
+
+
+@numba.njit(parallel=True, cache=True)
+def reduce_difference(stack, out):
+    n, size = stack.shape
+    nblocks = (size + BLOCK_SIZE - 1) // BLOCK_SIZE
+    for b in numba.prange(nblocks):
+        start = b * BLOCK_SIZE
+        end = min(size, start + BLOCK_SIZE)
+        acc = numpy.zeros(end - start, dtype=numpy.int32)
+        for p in range(start, end):
+            acc[p - start] = stack[0, p]
+        for i in range(1, n):
+            for p in range(start, end):
+                acc[p - start] -= stack[i, p]
+        for p in range(start, end):
+            out[p] = max(acc[p - start], 0)
+
+
+@numba.njit(parallel=True, cache=True)
+def reduce_weighted(stack, weights, out):
+    n, size = stack.shape
+    nblocks = (size + BLOCK_SIZE - 1) // BLOCK_SIZE
+    for b in numba.prange(nblocks):
+        start = b * BLOCK_SIZE
+        end = min(size, start + BLOCK_SIZE)
+        acc = numpy.zeros(end - start, dtype=numpy.float64)
+        for i in range(n):
+            w = weights[i]
+            for p in range(start, end):
+                acc[p - start] += w * stack[i, p]
+        for p in range(start, end):
+            out[p] = min(max(acc[p - start], 0.0), 255.0)
+
+
+@numba.njit(parallel=True, cache=True)
+def gather_random(stack, out):
+    """Pick every pixel of `out` (shape (pixels, channels)) from a uniformly
+    random frame of `stack` (shape (n, pixels, channels)).
+    """
+    n, pixels, channels = stack.shape
+    for p in numba.prange(pixels):
+        k = numpy.random.randint(0, n)
+        for c in range(channels):
+            out[p, c] = stack[k, p, c]
+
+
+@numba.njit(parallel=True, cache=True)
+def reservoir_update(current, frame, count):
+    """Reservoir sampling step: replace each pixel of `current` with the one
+    from `frame` with probability 1/count, where `count` is the number of
+    frames seen so far (including `frame`). Once all frames are seen, every
+    pixel comes from a uniformly random frame.
+    """
+    pixels, channels = current.shape
+    for p in numba.prange(pixels):
+        if numpy.random.randint(0, count) == 0:
+            for c in range(channels):
+                current[p, c] = frame[p, c]
+
+
+@numba.njit(cache=True)
+def _percentile_ranks(n, q):
+    """Order statistics and interpolation factor for the q-th percentile of
+    n values, following numpy's default (linear) method.
+    """
+    index = q / 100 * (n - 1)
+    lo = int(numpy.floor(index))
+    hi = min(lo + 1, n - 1)
+    return lo, hi, index - lo
+
+
+@numba.njit(cache=True)
+def _select(counts, lo, hi, t):
+    """Interpolate between the lo-th and hi-th smallest values described by a
+    histogram of counts.
+    """
+    a = -1
+    cumulative = 0
+    for v in range(counts.shape[0]):
+        cumulative += counts[v]
+        if a < 0 and cumulative > lo:
+            a = v
+        if cumulative > hi:
+            d = v - a
+            if t < 0.5:
+                return a + d * t
+            return v - d * (1 - t)
+    return 255.0
+
+
+@numba.njit(parallel=True, cache=True)
+def reduce_percentile(stack, q, out):
+    n, size = stack.shape
+    lo, hi, t = _percentile_ranks(n, q)
+    nblocks = (size + BLOCK_SIZE - 1) // BLOCK_SIZE
+    for b in numba.prange(nblocks):
+        start = b * BLOCK_SIZE
+        end = min(size, start + BLOCK_SIZE)
+        counts = numpy.zeros(256, dtype=numpy.int32)
+        for p in range(start, end):
+            for i in range(n):
+                counts[stack[i, p]] += 1
+            out[p] = _select(counts, lo, hi, t)
+            for i in range(n):
+                counts[stack[i, p]] = 0
+
+
+@numba.njit(parallel=True, cache=True)
+def histogram_add(histogram, frame):
+    """Count the values of `frame` (shape (rows, rowsize)) in the per-value
+    histograms `histogram` (shape (rows, rowsize, 256)).
+    """
+    rows, rowsize = frame.shape
+    for r in numba.prange(rows):
+        for p in range(rowsize):
+            histogram[r, p, frame[r, p]] += 1
+
+
+@numba.njit(parallel=True, cache=True)
+def histogram_percentile(histogram, n, q, out):
+    rows, rowsize, _ = histogram.shape
+    lo, hi, t = _percentile_ranks(n, q)
+    for r in numba.prange(rows):
+        for p in range(rowsize):
+            out[r, p] = _select(histogram[r, p], lo, hi, t)
@@ -16,10 +16,12 @@ from .resize import Resize
 from .respeed import Respeed
 from .retime_panorama import RetimePanorama
 from .scenes import Scenes
+from .similar import Similar
 from .split import Split
 from .squeeze import Squeeze
 from .stack import Stack
 from .timestamp import Timestamp
+from .warmup import Warmup
 
 
 TOOL_LIST: list[type[Tool]] = [
@@ -40,8 +42,10 @@ TOOL_LIST: list[type[Tool]] = [
     Respeed,
     RetimePanorama,
     Scenes,
+    Similar,
     Split,
     Squeeze,
     Stack,
     Timestamp,
+    Warmup,
 ]
\ No newline at end of file
@@ -26,10 +26,13 @@ class BlendFrames(OneToOneTool):
     @staticmethod
     def add_arguments(parser):
         OneToOneTool.add_arguments(parser)
-        parser.add_argument("-p", "--operation", type=str, default="average",
-            choices=["average", "brighter", "darker", "sum", "difference",
-                     "weight1", "weight3", "weight5", "weight10", "random"],
-            help="operation to blend the images together")
+        parser.add_argument("-p", "--operation", default="average",
+            type=utils.operation_type(["average", "brighter", "darker", "sum",
+                "difference", "weight1", "weight3", "weight5", "weight10",
+                "random", "median"]),
+            help="operation to blend the images together (average, brighter, "
+            "darker, sum, difference, weight1, weight3, weight5, weight10, "
+            "random, median or percentile:<p>)")
         parser.add_argument("-s", "--size", type=int, default=3,
             help="moving-window size (in frames) for blending")
         parser.add_argument("-f", "--fixed", action="store_true",
@@ -43,7 +46,7 @@ class BlendFrames(OneToOneTool):
     def process(self, input_file: utils.InputFile) -> pathlib.Path:
         import numpy
         output_path = self.inflate(input_file.path, {
-            "operation": self.opname,
+            "operation": self.opname.replace(":", ""),
             "size": self.size
         })
         with utils.VideoInput(input_file.path) as vin:
@@ -56,6 +59,7 @@ class BlendFrames(OneToOneTool):
             else:
                 length = vin.length + self.size - 1
                 framerate = vin.framerate
+            out = numpy.empty((vin.height, vin.width, 3), dtype=numpy.uint8)
             with utils.VideoOutput(output_path, vin.width, vin.height, framerate, length, hide_progress=self.quiet) as vout:
                 if self.fixed:
                     running = True
@@ -68,7 +72,7 @@ class BlendFrames(OneToOneTool):
                             running = False
                             if not frames:
                                 continue
-                        out_frame = self.operation(numpy.array(frames))
+                        out_frame = self.operation(numpy.array(frames), out)
                         for _ in frames:
                             vout.feed(out_frame)
                             if self.retime:
@@ -79,8 +83,8 @@ class BlendFrames(OneToOneTool):
                         frames.append(frame)
                         while len(frames) > self.size:
                             frames.pop(0)
-                        vout.feed(self.operation(numpy.array(frames)))
+                        vout.feed(self.operation(numpy.array(frames), out))
                     while len(frames) > 1:
                         frames.pop(0)
-                        vout.feed(self.operation(numpy.array(frames)))
+                        vout.feed(self.operation(numpy.array(frames), out))
         return output_path
@@ -13,14 +13,17 @@ class BlendImages(ManyToOneTool):
             operation: str = "average"):
         ManyToOneTool.__init__(self)
         self.opname = operation
-        self.operation = utils.getop(operation)
 
     @staticmethod
     def add_arguments(parser):
         ManyToOneTool.add_arguments(parser)
-        parser.add_argument("-p", "--operation", type=str, help="Operation to blend the images together", default="average", choices=["average", "brighter", "darker", "sum", "difference", "random"])
+        parser.add_argument("-p", "--operation", type=utils.operation_type(["average", "brighter", "darker", "sum", "difference", "random", "median"]), help="Operation to blend the images together (average, brighter, darker, sum, difference, random, median or percentile:<p>)", default="average")
 
     def process(self, inputs: list[utils.InputFile], output_path: pathlib.Path):
         import numpy, PIL.Image
-        out = self.operation(numpy.array([PIL.Image.open(i.path) for i in inputs]))
+        accumulator = utils.getaccumulator(self.opname)
+        for input_file in inputs:
+            with PIL.Image.open(input_file.path) as image:
+                accumulator.add(numpy.array(image))
+        out = accumulator.result()
         PIL.Image.fromarray(out.astype(numpy.uint8)).save(output_path)
@@ -20,12 +20,11 @@ class BlendToImage(OneToOneTool):
         self.exposure = exposure
         self.duration = utils.parse_exposure_duration(exposure)
         self.opname = operation
-        self.operation = utils.getop(operation)
 
     @staticmethod
     def add_arguments(parser):
         OneToOneTool.add_arguments(parser)
-        parser.add_argument("-p", "--operation", type=str, help="Operation to blend the frames together", default="average", choices=["average", "brighter", "darker", "sum", "difference", "random"])
+        parser.add_argument("-p", "--operation", type=utils.operation_type(["average", "brighter", "darker", "sum", "difference", "random", "median"]), help="Operation to blend the frames together (average, brighter, darker, sum, difference, random, median or percentile:<p>)", default="average")
         parser.add_argument("-ss", "--start-time", type=str, help="Starting timestamp, in FFMPEG format (HH:MM:SS.FFF)", default="00:00:00.000")
         parser.add_argument("-e", "--exposure", type=str, help="Exposure duration as a camera setting in seconds (1/100, 1/10, 1/4, 2, 30, ...)", default="1/10")
 
@@ -40,22 +39,21 @@ class BlendToImage(OneToOneTool):
 
     def _merge_frames(self, folder: pathlib.Path, output_path: pathlib.Path):
         import numpy, PIL.Image
-        frame_paths = list(filter(lambda p: p.is_file(), folder.glob("*")))
+        frame_paths = sorted(filter(lambda p: p.is_file(), folder.glob("*")))
         if not frame_paths:
             raise RuntimeError("No frame to merge")
-        images = []
+        accumulator = utils.getaccumulator(self.opname)
         for frame_path in frame_paths:
             with PIL.Image.open(frame_path) as file:
-                images.append(numpy.array(file))
-        stack = numpy.array(images)
-        merger = self.operation(stack)
+                accumulator.add(numpy.array(file))
+        merger = accumulator.result()
         PIL.Image.fromarray(numpy.uint8(merger)).save(output_path)
 
     def process(self, input_file: utils.InputFile) -> pathlib.Path:
         with utils.tempdir() as folder:
             self._extract_frames(input_file.path, folder)
             output_path = self.inflate(input_file.path, {
-                "operation": self.opname,
+                "operation": self.opname.replace(":", ""),
                 "exposure": self.exposure
             })
             self._merge_frames(folder, output_path)
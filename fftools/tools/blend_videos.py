@@ -1,11 +1,58 @@
 import contextlib
+import dataclasses
+import os
 import pathlib
+import shutil
+import typing
 import warnings
 
 from ..tool import ManyToOneTool
 from .. import utils
 
 
+TREE_OPERATIONS = ["average", "brighter", "darker", "sum"]
+
+
+@dataclasses.dataclass
+class Intermediate:
+    """Partial reduction of a group of inputs, stored losslessly as raw
+    frames. Maximum and minimum reductions are kept as uint8, while sums
+    (also used for averages) are kept as the smallest unsigned integers that
+    hold them exactly, along with the count of inputs they accumulate.
+    """
+    path: pathlib.Path
+    width: int
+    height: int
+    framerate: float
+    length: int
+    dtype: str
+    count: int
+
+    def delete(self):
+        if self.path.exists():
+            os.remove(self.path)
+
+    def frames(self) -> typing.Generator:
+        import numpy
+        shape = (self.height, self.width, 3)
+        frame_size = self.width * self.height * 3 * numpy.dtype(self.dtype).itemsize
+        with self.path.open("rb") as file:
+            for _ in range(self.length):
+                buffer = file.read(frame_size)
+                if len(buffer) < frame_size:
+                    break
+                yield numpy.frombuffer(buffer, dtype=self.dtype).reshape(shape)
+
+
+@dataclasses.dataclass
+class Source:
+    width: int
+    height: int
+    framerate: float | None
+    count: int
+    frames: typing.Iterator
+
+
 class BlendVideos(ManyToOneTool):
 
     NAME = "blend-videos"
@@ -17,7 +64,8 @@ class BlendVideos(ManyToOneTool):
             time_end: str | None = None,
             duration: str | None = None,
             framerate: float | None = None,
-            offline: bool = False):
+            offline: bool = False,
+            fan_in: int | None = None):
         ManyToOneTool.__init__(self)
         self.time_start = time_start
         self.time_end = time_end
@@ -25,17 +73,24 @@ class BlendVideos(ManyToOneTool):
         self.opname = operation
         self.framerate = framerate
         self.offline = offline
+        self.fan_in = fan_in
+        if self.fan_in is not None:
+            if self.fan_in < 2:
+                raise ValueError("Fan-in must be at least 2")
+            if self.opname not in TREE_OPERATIONS:
+                raise ValueError(f"Operation '{self.opname}' can not be reduced hierarchically, use one of {', '.join(TREE_OPERATIONS)}")
         self.operation = utils.getop(operation)
 
     @staticmethod
     def add_arguments(parser):
         ManyToOneTool.add_arguments(parser)
-        parser.add_argument("-p", "--operation", type=str, help="Operation to blend the images together", default="average", choices=["average", "brighter", "darker", "sum", "difference", "random"])
+        parser.add_argument("-p", "--operation", type=utils.operation_type(["average", "brighter", "darker", "sum", "difference", "random", "median"]), help="Operation to blend the images together (average, brighter, darker, sum, difference, random, median or percentile:<p>)", default="average")
         parser.add_argument("-ss", "--time-start", type=str, help="Starting timestamp, in FFMPEG format (HH:MM:SS.FFF)", default=None)
         parser.add_argument("-to", "--time-end", type=str, help="Ending timestamp, in FFMPEG format (HH:MM:SS.FFF)", default=None)
         parser.add_argument("-t", "--duration", type=str, help="Duration of the clip to extract, in FFMPEG format (HH:MM:SS.FFF)", default=None)
         parser.add_argument("-r", "--framerate", type=float, help="Framerate output (used if all inputs are folders)", default=None)
         parser.add_argument("--offline", action="store_true", help="Use offline frame extraction (as files), which is slower but less RAM intensive")
+        parser.add_argument("--fan-in", type=int, default=None, help="Maximum number of inputs opened at once; inputs are then reduced hierarchically through lossless intermediates (only for associative operations: %s)" % ", ".join(TREE_OPERATIONS))
 
     def _process_online(self, inputs: list[utils.InputFile], output_path: pathlib.Path):
         import numpy
@@ -46,6 +101,7 @@ class BlendVideos(ManyToOneTool):
             for video_input in video_inputs:
                 stack.enter_context(video_input)
             min_length = min(vin.length for vin in video_inputs)
+            out = numpy.empty((video_inputs[0].height, video_inputs[0].width, 3), dtype=numpy.uint8)
             with utils.VideoOutput(output_path, video_inputs[0].width, video_inputs[0].height, video_inputs[0].framerate, min_length, hide_progress=self.quiet) as vout:
                 while True:
                     frames: list[numpy.ndarray] = []
@@ -58,7 +114,18 @@ class BlendVideos(ManyToOneTool):
                             break
                     if stop:
                         break
-                    vout.feed(self.operation(numpy.array(frames)))
+                    vout.feed(self.operation(numpy.array(frames), out))
+
+    def _extract_frames(self, input_file: utils.InputFile, folder: pathlib.Path):
+        cmd = ["-i", input_file.path]
+        if self.time_start is not None:
+            cmd += ["-ss", self.time_start]
+        if self.time_end is not None:
+            cmd += ["-to", self.time_end]
+        if self.duration is not None:
+            cmd += ["-t", self.duration]
+        cmd += [folder / "%09d.png"]
+        utils.ffmpeg(*cmd, show_stats=not self.quiet)
 
     def _process_offline(self, inputs: list[utils.InputFile], output_path: pathlib.Path):
         import numpy, PIL.Image
@@ -75,16 +142,7 @@ class BlendVideos(ManyToOneTool):
                     framerate = input_file.probe.framerate
                 temp_folder = temp_root / f"{i}"
                 temp_folder.mkdir()
-                cmd = ["-i", input_file]
-                if self.time_start is not None:
-                    cmd += ["-ss", self.time_start]
-                if self.time_end is not None:
-                    cmd += ["-to", self.time_end]
-                if self.duration is not None:
-                    cmd += ["-t", self.duration]
-                template = temp_folder / "%09d.png"
-                cmd += [template]
-                utils.ffmpeg(*cmd, show_stats=not self.quiet)
+                self._extract_frames(input_file, temp_folder)
                 folders.append(temp_folder)
             if not folders:
                 warnings.warn("No input found")
@@ -102,16 +160,147 @@ class BlendVideos(ManyToOneTool):
                 framerate = self.framerate
             if height is None or framerate is None:
                 raise ValueError("Some video output parameters are not defined")
+            out = numpy.empty((height, width, 3), dtype=numpy.uint8)
             with utils.VideoOutput(output_path, width, height, framerate, min_size, hide_progress=self.quiet) as vout:
                 for j in range(min_size):
                     frames = []
                     for folder in folders:
                         frame = PIL.Image.open(folder / f"{(j+1):09d}.png")
                         frames.append(frame)
-                    vout.feed(self.operation(numpy.array(frames)))
+                    vout.feed(self.operation(numpy.array(frames), out))
+
+    @contextlib.contextmanager
+    def _open_source(self, source: "utils.InputFile | Intermediate", temp_root: pathlib.Path) -> typing.Generator[Source, typing.Any, None]:
+        import numpy, PIL.Image
+
+        def iter_folder(folder: pathlib.Path):
+            for path in sorted(folder.glob("*.png")):
+                with PIL.Image.open(path) as image:
+                    yield numpy.array(image.convert("RGB"))
+
+        if isinstance(source, Intermediate):
+            yield Source(source.width, source.height, source.framerate, source.count, source.frames())
+        elif source.path.is_dir() or self.offline:
+            if source.path.is_dir():
+                folder = source.path
+                framerate = self.framerate
+            else:
+                folder = temp_root / utils.generate_nonce(8)
+                folder.mkdir()
+                self._extract_frames(source, folder)
+                framerate = source.probe.framerate
+            first = next(iter(sorted(folder.glob("*.png"))), None)
+            if first is None:
+                raise ValueError(f"Input {source.path} is empty")
+            with PIL.Image.open(first) as image:
+                width, height = image.size
+            try:
+                yield Source(width, height, framerate, 1, iter_folder(folder))
+            finally:
+                if folder != source.path:
+                    shutil.rmtree(folder)
+        else:
+            with utils.VideoInput(source.path) as vin:
+                yield Source(vin.width, vin.height, vin.framerate, 1, vin)
+
+    def _reduce(self, sources: list, temp_root: pathlib.Path, output_path: pathlib.Path | None = None) -> Intermediate | None:
+        """Blend a group of sources (inputs or intermediates) together. If
+        `output_path` is None, the result is written as a new intermediate,
+        otherwise it is finalized and encoded to the output video.
+        """
+        import numpy
+        with contextlib.ExitStack() as stack:
+            opened = [stack.enter_context(self._open_source(source, temp_root)) for source in sources]
+            width, height = opened[0].width, opened[0].height
+            framerate = next((s.framerate for s in opened if s.framerate is not None), self.framerate)
+            if framerate is None:
+                raise ValueError("Please provide a framerate")
+            count = sum(s.count for s in opened)
+            if output_path is None:
+                if self.opname in ["brighter", "darker"]:
+                    dtype = "uint8"
+                else:
+                    dtype = "uint16" if count * 255 <= 0xFFFF else "uint32"
+                node = Intermediate(temp_root / f"{utils.generate_nonce(8)}.raw", width, height, framerate, 0, dtype, count)
+                with node.path.open("wb") as file:
+                    for frames in zip(*[s.frames for s in opened]):
+                        file.write(self._accumulate(frames).astype(node.dtype).tobytes())
+                        node.length += 1
+                return node
+            with utils.VideoOutput(output_path, width, height, framerate, hide_progress=self.quiet) as vout:
+                for frames in zip(*[s.frames for s in opened]):
+                    accumulation = self._accumulate(frames)
+                    if self.opname == "average":
+                        vout.feed(accumulation / count)
+                    elif self.opname == "sum":
+                        vout.feed(numpy.minimum(accumulation, 255))
+                    else:
+                        vout.feed(accumulation)
+        return None
+
+    def _accumulate(self, frames: tuple):
+        import numpy
+        match self.opname:
+            case "brighter":
+                return numpy.max(frames, axis=0)
+            case "darker":
+                return numpy.min(frames, axis=0)
+            case _:
+                return numpy.sum(frames, axis=0, dtype=numpy.uint32)
+
+    def _process_tree(self, inputs: list[utils.InputFile], output_path: pathlib.Path):
+        """Blend inputs at most `fan_in` at a time. Intermediates are merged
+        as soon as `fan_in` of them share the same depth, so that at most
+        `fan_in` sources are opened at once and no more than `fan_in` times
+        the tree depth intermediates exist on disk.
+        """
+        import tqdm
+        assert self.fan_in is not None
+        if not inputs:
+            warnings.warn("No input found")
+            return
+        k = self.fan_in
+        with utils.tempdir() as temp_root:
+            levels: list[list[Intermediate]] = []
+
+            def reduce_nodes(nodes: list[Intermediate]) -> Intermediate:
+                node = self._reduce(nodes, temp_root)
+                assert node is not None
+                for child in nodes:
+                    child.delete()
+                return node
+
+            def push(node: Intermediate, depth: int):
+                while True:
+                    if len(levels) <= depth:
+                        levels.append([])
+                    levels[depth].append(node)
+                    if len(levels[depth]) < k:
+                        break
+                    node = reduce_nodes(levels[depth])
+                    levels[depth] = []
+                    depth += 1
+
+            if len(inputs) <= k:
+                self._reduce(inputs, temp_root, output_path)
+                return
+            groups = [inputs[i:i+k] for i in range(0, len(inputs), k)]
+            for group in tqdm.tqdm(groups, desc="Reducing", unit="group", disable=self.quiet):
+                node = self._reduce(group, temp_root)
+                assert node is not None
+                push(node, 0)
+            nodes = [node for level in levels for node in level]
+            while len(nodes) > k:
+                nodes = [reduce_nodes(nodes[i:i+k]) for i in range(0, len(nodes), k)]
+            if min(node.length for node in nodes) == 0:
+                warnings.warn("(At least) one input is empty")
+                return
+            self._reduce(nodes, temp_root, output_path)
 
     def process(self, inputs: list[utils.InputFile], output_path: pathlib.Path):
-        if self.offline:
+        if self.fan_in is not None:
+            self._process_tree(inputs, output_path)
+        elif self.offline:
             self._process_offline(inputs, output_path)
         else:
             self._process_online(inputs, output_path)
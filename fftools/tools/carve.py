@@ -14,18 +14,28 @@ class Carve(OneToOneTool):
     """
 
     NAME = "carve"
-    DESC = "Resize an image with seam carving."
+    DESC = "Resize an image or a video with seam carving."
     OUTPUT_PATH_TEMPLATE = "{parent}/{stem}_carved_{width}x{height}{suffix}"
 
     def __init__(self,
             template: str,
             width: int | None = None,
             height: int | None = None,
-            aspect: str | None = None):
+            aspect: str | None = None,
+            seam_map: bool = False,
+            pyramid: int = 0,
+            tolerance: int = 2,
+            batch: int = 1,
+            radius: int = 8):
         OneToOneTool.__init__(self, template)
         self.width = width
         self.height = height
         self.aspect_ratio = utils.parse_aspect_ratio(aspect)
+        self.seam_map = seam_map
+        self.pyramid = pyramid
+        self.tolerance = tolerance
+        self.batch = batch
+        self.radius = radius
 
     @staticmethod
     def add_arguments(parser):
@@ -33,8 +43,23 @@ class Carve(OneToOneTool):
         parser.add_argument("-w", "--width", type=int, default=None, help="target width in pixels")
         parser.add_argument("-g", "--height", type=int, default=None, help="target height in pixels")
         parser.add_argument("-a", "--aspect", type=str, default=None, help="target aspect ratio")
+        parser.add_argument("-m", "--seam-map", action="store_true", help="with images, compute the removal order of every pixel once, store it next to the input (as <input>.seams.npz) and resize from it; later resizes of the same image to any size are then instant")
+        parser.add_argument("-p", "--pyramid", type=int, default=0, help="with images, number of times the image is halved to search seams approximately before refining them at full resolution (0 for exact seams)")
+        parser.add_argument("-t", "--tolerance", type=int, default=2, help="with images and --pyramid, half-width of the refinement band around each projected seam, in downscaled pixels; larger is slower but closer to exact seams")
+        parser.add_argument("-b", "--batch", type=int, default=1, help="with images and without --pyramid, number of non-crossing seams extracted from each energy computation; 0 adapts it to the spread of seam energies")
+        parser.add_argument("-r", "--radius", type=int, default=8, help="with videos, seams of each frame are searched within this many columns of the seams of the previous frame")
 
     def process(self, input_file: utils.InputFile) -> pathlib.Path:
+        if utils.is_video(input_file.path):
+            image_options = [
+                ("--seam-map", self.seam_map),
+                ("--pyramid", self.pyramid != 0),
+                ("--tolerance", self.tolerance != 2),
+                ("--batch", self.batch != 1),
+            ]
+            ignored = [name for name, is_set in image_options if is_set]
+            if ignored:
+                raise ValueError(f"{', '.join(ignored)} only apply to images, not to videos")
         target_width = self.width
         target_height = self.height
         if target_width is None and target_height is None and self.aspect_ratio is None:
@@ -67,166 +92,108 @@ class Carve(OneToOneTool):
             "width": target_width,
             "height": target_height,
         })
-        seam_carve(input_file.path, dx, dy, output_path, quiet=self.quiet)
+        if utils.is_video(input_file.path):
+            carve_video(input_file.path, dx, dy, output_path, quiet=self.quiet, radius=self.radius)
+        elif self.seam_map:
+            seam_map = load_seam_map(input_file.path, quiet=self.quiet)
+            seam_carve_from_map(input_file.path, seam_map, target_width, target_height, output_path)
+        else:
+            seam_carve(input_file.path, dx, dy, output_path, quiet=self.quiet, levels=self.pyramid, tolerance=self.tolerance, batch=self.batch)
         return output_path
 
 
-def seam_carve(
+def seam_map_path(input_path: pathlib.Path) -> pathlib.Path:
+    return utils.sidecar_path(input_path, ".seams.npz")
+
+
+def load_seam_map(
         input_path: pathlib.Path,
-        dx: int,
-        dy: int,
-        output_path: pathlib.Path,
         use_forward_energy: bool = True,
         quiet: bool = False
-        ):
-    import cv2, numba, numpy, scipy.ndimage
-
-    def rotate_image(image, clockwise):
-        k = 1 if clockwise else 3
-        return numpy.rot90(image, k)
-
-    def backward_energy(im):
-        xgrad = scipy.ndimage.convolve1d(im, numpy.array([1, 0, -1]), axis=1, mode='wrap')
-        ygrad = scipy.ndimage.convolve1d(im, numpy.array([1, 0, -1]), axis=0, mode='wrap')
-        grad_mag = numpy.sqrt(numpy.sum(xgrad**2, axis=2) + numpy.sum(ygrad**2, axis=2))
-        return grad_mag
-    
-    def forward_energy(im):
-        """
-        Forward energy algorithm as described in "Improved Seam Carving for Video Retargeting"
-        by Rubinstein, Shamir, Avidan.
-
-        Vectorized code adapted from
-        https://github.com/axu2/improved-seam-carving.
-        """
-        h, w = im.shape[:2]
-        im = cv2.cvtColor(im.astype(numpy.uint8), cv2.COLOR_BGR2GRAY).astype(numpy.float64)
-        
-        energy = numpy.zeros((h, w))
-        m = numpy.zeros((h, w))
-
-        U = numpy.roll(im, 1, axis=0)
-        L = numpy.roll(im, 1, axis=1)
-        R = numpy.roll(im, -1, axis=1)
-
-        cU = numpy.abs(R - L)
-        cL = numpy.abs(U - L) + cU
-        cR = numpy.abs(U - R) + cU
-
-        for i in range(1, h):
-            mU = m[i-1]
-            mL = numpy.roll(mU, 1)
-            mR = numpy.roll(mU, -1)
-
-            mULR = numpy.array([mU, mL, mR])
-            cULR = numpy.array([cU[i], cL[i], cR[i]])
-            mULR += cULR
-
-            argmins = numpy.argmin(mULR, axis=0)
-            m[i] = numpy.choose(argmins, mULR)
-            energy[i] = numpy.choose(argmins, cULR)
-
-        return energy
-
-    @numba.njit
-    def add_seam(im, seam_idx):
-        """
-        Add a vertical seam to a 3-channel color image at the indices provided
-        by averaging the pixels values to the left and right of the seam.
+        ) -> dict:
+    """Seam-order maps of an image, cached in a sidecar file. The
+    "horizontal" map holds the removal order of each pixel when removing
+    vertical seams, the "vertical" one when removing horizontal seams.
+    """
+    import cv2, numpy
+    from .. import carving
 
-        Code adapted from https://github.com/vivianhylee/seam-carving.
-        """
+    def compute() -> dict:
+        im = cv2.imread(input_path.as_posix())
+        if im is None:
+            raise ValueError(f"Could not load {input_path}")
         h, w = im.shape[:2]
-        output = numpy.zeros((h, w + 1, 3))
-        for row in range(h):
-            col = seam_idx[row]
-            for ch in range(3):
-                if col == 0:
-                    p = numpy.mean(im[row, col: col + 2, ch])
-                    output[row, col, ch] = im[row, col, ch]
-                    output[row, col + 1, ch] = p
-                    output[row, col + 1:, ch] = im[row, col:, ch]
-                else:
-                    p = numpy.mean(im[row, col - 1: col + 1, ch])
-                    output[row, : col, ch] = im[row, : col, ch]
-                    output[row, col, ch] = p
-                    output[row, col + 1:, ch] = im[row, col:, ch]
-
-        return output
+        pbar = tqdm.tqdm(total=(w - 1) + (h - 1), desc="Seam map", disable=quiet)
+        horizontal = carving.seam_order(im, use_forward_energy, lambda: pbar.update(1))
+        vertical = numpy.rot90(carving.seam_order(numpy.rot90(im, 1), use_forward_energy, lambda: pbar.update(1)), 3)
+        pbar.close()
+        return {"horizontal": horizontal, "vertical": numpy.ascontiguousarray(vertical)}
 
-    def remove_seam(im, boolmask):
-        h, w = im.shape[:2]
-        boolmask3c = numpy.stack([boolmask] * 3, axis=2)
-        return im[boolmask3c].reshape((h, w - 1, 3))
+    data = utils.load_sidecar(seam_map_path(input_path), input_path, {"forward": use_forward_energy}, compute)
+    return {"horizontal": data["horizontal"], "vertical": data["vertical"]}
 
-    def get_minimum_seam(im):
-        """
-        DP algorithm for finding the seam of minimum energy. Code adapted from
-        https://karthikkaranth.me/blog/implementing-seam-carving-with-python/
-        """
-        h, w = im.shape[:2]
-        energyfn = forward_energy if use_forward_energy else backward_energy
-        M = energyfn(im)
-        seam_idx, boolmask = compute_shortest_path(M, im, h, w)
-        return numpy.array(seam_idx), boolmask
 
-    @numba.njit
-    def compute_shortest_path(M, im, h, w):
-        backtrack = numpy.zeros_like(M, dtype=numpy.int_)
-        for i in range(1, h):
-            for j in range(0, w):
-                if j == 0:
-                    idx = numpy.argmin(M[i - 1, j:j + 2])
-                    backtrack[i, j] = idx + j
-                    min_energy = M[i-1, idx + j]
-                else:
-                    idx = numpy.argmin(M[i - 1, j - 1:j + 2])
-                    backtrack[i, j] = idx + j - 1
-                    min_energy = M[i - 1, idx + j - 1]
+def seam_carve_from_map(
+        input_path: pathlib.Path,
+        seam_map: dict,
+        target_width: int,
+        target_height: int,
+        output_path: pathlib.Path
+        ):
+    """Resize an image by masking its seam-order maps, without any DP. When
+    both dimensions change, the width is set first, and the vertical orders
+    of the remaining pixels are then used by rank within each column, which
+    approximates carving horizontal seams in the narrowed image.
+    """
+    import cv2, numpy
+    from .. import carving
+    im = cv2.imread(input_path.as_posix())
+    if im is None:
+        raise ValueError(f"Could not load {input_path}")
+    h, w = im.shape[:2]
+    assert 0 < target_width <= 2 * w and 0 < target_height <= 2 * h
+    vertical = seam_map["vertical"]
+    if target_width != w:
+        im, vertical = carving.retarget(seam_map["horizontal"], target_width, im, vertical)
+    if target_height != h:
+        im, = carving.retarget(vertical.T, target_height, im.transpose(1, 0, 2))
+        im = im.transpose(1, 0, 2)
+    cv2.imwrite(output_path.as_posix(), numpy.ascontiguousarray(im))
 
-                M[i, j] += min_energy
 
-        seam_idx = []
-        boolmask = numpy.ones((h, w), dtype=numpy.bool_)
-        j = numpy.argmin(M[-1])
-        for i in range(h-1, -1, -1):
-            boolmask[i, j] = False
-            seam_idx.append(j)
-            j = backtrack[i, j]
+def seam_carve(
+        input_path: pathlib.Path,
+        dx: int,
+        dy: int,
+        output_path: pathlib.Path,
+        use_forward_energy: bool = True,
+        quiet: bool = False,
+        levels: int = 0,
+        tolerance: int = 2,
+        batch: int = 1
+        ):
+    import cv2, numpy
+    from .. import carving
 
-        seam_idx.reverse()
-        return seam_idx, boolmask
+    def rotate_image(image, clockwise):
+        k = 1 if clockwise else 3
+        return numpy.ascontiguousarray(numpy.rot90(image, k))
 
     def seams_removal(im, num_remove, pbar: tqdm.tqdm):
         pbar.set_description("Seams removal")
-        for _ in range(num_remove):
-            seam_idx, boolmask = get_minimum_seam(im)
-            im = remove_seam(im, boolmask)
-            pbar.update(1)
-        return im
+        carver, _ = carving.remove_seams(im, num_remove, use_forward_energy, levels, tolerance, batch, lambda: pbar.update(1))
+        return carver.materialize()
 
     def seams_insertion(im, num_add, pbar: tqdm.tqdm):
         pbar.set_description("Seams insertion")
-        seams_record = []
-        temp_im = im.copy()
-        for _ in range(num_add):
-            seam_idx, boolmask = get_minimum_seam(temp_im)
-            seams_record.append(seam_idx)
-            temp_im = remove_seam(temp_im, boolmask)
-            pbar.update(1)
-        seams_record.reverse()
-        for _ in range(num_add):
-            seam = seams_record.pop()
-            im = add_seam(im, seam)
-            for remaining_seam in seams_record:
-                remaining_seam[numpy.where(remaining_seam >= seam)] += 2
-            pbar.update(1)
-        return im
+        _, seams = carving.remove_seams(im, num_add, use_forward_energy, levels, tolerance, batch, lambda: pbar.update(1))
+        output = carving.widen(im, seams)
+        pbar.update(num_add)
+        return output
 
     im = cv2.imread(input_path.as_posix())
     if im is None:
         raise ValueError(f"Could not load {input_path}")
-    im = im.astype(numpy.float64)
     h, w = im.shape[:2]
     assert h + dy > 0 and w + dx > 0 and dy <= h and dx <= w
     output = im
@@ -253,4 +220,41 @@ def seam_carve(
         output = seams_insertion(output, dy, pbar)
         output = rotate_image(output, False)
     pbar.close()
-    cv2.imwrite(output_path.as_posix(), output.astype(numpy.uint8))
+    cv2.imwrite(output_path.as_posix(), output)
+
+
+def carve_video(
+        input_path: pathlib.Path,
+        dx: int,
+        dy: int,
+        output_path: pathlib.Path,
+        use_forward_energy: bool = True,
+        quiet: bool = False,
+        radius: int = 8
+        ):
+    import numpy
+    from .. import carving
+
+    def resize(tracker: carving.SeamTracker, image, delta: int):
+        carver, seams = tracker.remove_seams(image)
+        if delta < 0:
+            return carver.materialize()
+        return carving.widen(image, seams)
+
+    with utils.VideoInput(input_path) as video_input:
+        h, w = video_input.height, video_input.width
+        assert h + dy > 0 and w + dx > 0 and dy <= h and dx <= w
+        horizontal = carving.SeamTracker(abs(dx), use_forward_energy, radius)
+        vertical = carving.SeamTracker(abs(dy), use_forward_energy, radius)
+        with utils.VideoOutput(output_path, w + dx, h + dy, video_input.framerate,
+                length=video_input.length, hide_progress=quiet) as video_output:
+            for frame in video_input:
+                # Frames are RGB while carvers expect BGR
+                output = numpy.ascontiguousarray(frame[:, :, ::-1])
+                if dx != 0:
+                    output = resize(horizontal, output, dx)
+                if dy != 0:
+                    output = numpy.ascontiguousarray(numpy.rot90(output, 1))
+                    output = resize(vertical, output, dy)
+                    output = numpy.rot90(output, 3)
+                video_output.feed(numpy.ascontiguousarray(output[:, :, ::-1]))
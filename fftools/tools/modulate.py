@@ -1,3 +1,4 @@
+import functools
 import pathlib
 
 import cv2
@@ -7,54 +8,169 @@ from ..tool import OneToOneTool
 from .. import utils
 
 
-def filter_random(fft: numpy.ndarray, alpha: float):
-    height, width = fft.shape
-    fft[numpy.where(numpy.random.random((height, width)) <= alpha)] = 0
-
-
-def filter_outer(fft: numpy.ndarray, alpha: float):
-    height, width = fft.shape
-    ralpha = 1 - alpha
-    fft[:int(alpha*height),:] = 0
-    fft[int(ralpha*height):,:] = 0
-    fft[:,:int(alpha*width)] = 0
-    fft[:,int(ralpha*width):] = 0
-
+# Peak memory footprint of a video frame in a batch, per pixel: the RGB
+# input (3), the float32 luma (4), then the largest of the two filtering
+# paths. The spatial path holds three float32 buffers at once (12): the
+# outer product, the filtered frame and the temporary of its identity term
+# or of the inner difference. The FFT path holds the complex64 half spectrum
+# (4), the complex64 copy made by the inverse transform over the first axis
+# (4) and its float32 output (4). The 8-bit output is allocated once these
+# temporaries are released.
+BYTES_PER_PIXEL = 3 + 4 + max(3 * 4, 4 + 4 + 4)
 
-def filter_inner(fft: numpy.ndarray, alpha: float):
-    height, width = fft.shape
-    i0 = int(height * .5 * (1 - alpha))
-    i1 = int(height * .5 * (1 + alpha))
-    j0 = int(width * .5 * (1 - alpha))
-    j1 = int(width * .5 * (1 + alpha))
-    fft[i0:i1,j0:j1] = 0
+# Maximum total rank of the axis filters for outer and inner filtering to run
+# in the spatial domain; above it, an FFT is cheaper
+MAX_SPATIAL_RANK = 128
 
 
-def filter_scale(fft: numpy.ndarray, alpha: float):
-    fft *= alpha
-
-
-def filter_frame(frame: cv2.Mat | numpy.ndarray, method: str, alpha: float) -> numpy.ndarray:
-    hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-    gray = hsv[:,:,2]
-    fft = numpy.fft.fft2(gray)
-    if method == "random":
-        filter_random(fft, alpha)
+def filter_random(fft: numpy.ndarray, alpha: float):
+    fft *= numpy.random.random(fft.shape) > alpha
+
+
+def band(n: int, start: int, stop: int) -> numpy.ndarray:
+    """Indicator of frequencies start to stop (excluded) out of n, averaged
+    with its mirror image (frequency k with frequency -k), so that filtering
+    a real signal with it gives a real signal.
+    """
+    mask = numpy.zeros(n, dtype=numpy.float32)
+    mask[start:stop] = 1
+    return 0.5 * (mask + numpy.roll(mask[::-1], 1))
+
+
+@functools.lru_cache(maxsize=16)
+def axis_bands(shape: tuple[int, int], method: str, alpha: float) -> tuple[numpy.ndarray, numpy.ndarray]:
+    """Bands of frequencies along each axis for the outer and inner methods,
+    which are separable: outer keeps the frequencies within both bands (ie.
+    cuts off the lowest ones), inner removes them (ie. cuts off the highest
+    ones).
+    """
     if method == "outer":
-        filter_outer(fft, alpha)
+        return tuple(band(n, int(alpha * n), int((1 - alpha) * n)) for n in shape)
+    return tuple(band(n, int(n * .5 * (1 - alpha)), int(n * .5 * (1 + alpha))) for n in shape)
+
+
+@functools.lru_cache(maxsize=16)
+def frequency_mask(shape: tuple[int, int], method: str, alpha: float) -> numpy.ndarray:
+    """Multiplier for the real FFT (of shape (height, width // 2 + 1)) of a
+    frame of the given shape, for deterministic methods.
+    """
+    height, width = shape
+    if method in ["outer", "inner"]:
+        rows, cols = axis_bands(shape, method, alpha)
+        mask = numpy.outer(rows, cols[:width // 2 + 1])
+        return mask if method == "outer" else 1 - mask
+    return numpy.full((height, width // 2 + 1), alpha if method == "scale" else 1, dtype=numpy.float32)
+
+
+@functools.lru_cache(maxsize=16)
+def axis_filter(mask: bytes, n: int) -> tuple[float, numpy.ndarray, numpy.ndarray]:
+    """Write the real filter multiplying the spectrum of signals of length n
+    by a symmetric mask (given as float32 bytes, for caching) as
+    s * I + B diag(w) B^T, where B holds orthonormal cosines and sines of the
+    frequencies where the mask differs from s, s being chosen so that they
+    are as few as possible. Return s, B and w.
+    """
+    values = numpy.frombuffer(mask, dtype=numpy.float32)[:n // 2 + 1]
+    s = 1.0 if numpy.count_nonzero(values != 1) < numpy.count_nonzero(values) else 0.0
+    t = numpy.arange(n) * 2 * numpy.pi / n
+    columns, weights = [], []
+    for k in numpy.flatnonzero(values != s):
+        if k == 0 or 2 * k == n:
+            columns.append(numpy.cos(k * t) / numpy.sqrt(n))
+            weights.append(values[k] - s)
+        else:
+            columns += [numpy.cos(k * t) * numpy.sqrt(2 / n), numpy.sin(k * t) * numpy.sqrt(2 / n)]
+            weights += [values[k] - s] * 2
+    basis = numpy.array(columns, dtype=numpy.float32).reshape(-1, n).T
+    return s, basis, numpy.array(weights, dtype=numpy.float32)
+
+
+def spatial_filters(shape: tuple[int, int], method: str, alpha: float):
+    """Filters along each axis (see `axis_filter`) for the outer and inner
+    methods, or None if they are too expensive compared to an FFT.
+    """
+    filters = [axis_filter(mask.tobytes(), n) for mask, n in zip(axis_bands(shape, method, alpha), shape)]
+    if sum(basis.shape[1] for _, basis, _ in filters) > MAX_SPATIAL_RANK:
+        return None
+    return filters
+
+
+def filter_spatial(gray: numpy.ndarray, method: str, filters) -> numpy.ndarray:
+    """Outer or inner filtering of a stack of frames of shape (n, height,
+    width) as products with the axis filters, without an FFT.
+    """
+    (sr, br, wr), (sc, bc, wc) = filters
+    out = numpy.matmul(br, wr[:, numpy.newaxis] * numpy.matmul(br.T, gray))
+    if sr:
+        out += sr * gray
+    filtered = numpy.matmul(numpy.matmul(out, bc) * wc, bc.T)
+    if sc:
+        filtered += sc * out
     if method == "inner":
-        filter_inner(fft, alpha)
-    if method == "scale":
-        filter_scale(fft, alpha)
-    return numpy.round(numpy.abs(numpy.fft.ifft2(fft))).astype(numpy.uint8)
+        filtered = gray - filtered
+    return filtered
+
+
+def luma(frame: cv2.Mat | numpy.ndarray) -> numpy.ndarray:
+    """Value channel of the HSV representation of a frame, ie. the maximum of
+    its channels, which does not depend on their order.
+    """
+    return numpy.maximum(numpy.maximum(frame[...,0], frame[...,1]), frame[...,2])
+
+
+def filter_frames(frames: numpy.ndarray, method: str, alpha: float, workers: int = -1, spatial: bool = True) -> numpy.ndarray:
+    """Filter a stack of frames of shape (n, height, width, channels) at once.
+    Return the 8-bit filtered luma, of shape (n, height, width). Unless
+    `spatial` is False, scaling is applied directly and outer and inner
+    filters are applied as separable products when their bands are narrow
+    enough; otherwise a single multi-threaded FFT is run over the last two
+    axes.
+    """
+    import scipy.fft
+    gray = luma(frames)
+    shape = gray.shape[-2:]
+    if spatial and method == "scale":
+        return cv2.convertScaleAbs(gray.reshape(-1, shape[1]), alpha=alpha).reshape(gray.shape)
+    gray = gray.astype(numpy.float32)
+    filters = None
+    if spatial and method in ["outer", "inner"]:
+        filters = spatial_filters(shape, method, alpha)
+    if filters is not None:
+        filtered = filter_spatial(gray, method, filters)
+    else:
+        fft = scipy.fft.rfft2(gray, axes=(-2, -1), workers=workers)
+        if method == "random":
+            filter_random(fft, alpha)
+        else:
+            fft *= frequency_mask(shape, method, alpha)
+        filtered = scipy.fft.irfft2(fft, s=shape, axes=(-2, -1), workers=workers)
+    return cv2.convertScaleAbs(filtered.reshape(-1, shape[1])).reshape(gray.shape)
+
 
+def filter_frame(frame: cv2.Mat | numpy.ndarray, method: str, alpha: float, workers: int = -1) -> numpy.ndarray:
+    return filter_frames(frame[numpy.newaxis], method, alpha, workers)[0]
 
-def modulate_video(input_path: pathlib.Path, output_path: pathlib.Path, method: str, alpha: float, quiet: bool):
+
+def modulate_video(input_path: pathlib.Path, output_path: pathlib.Path, method: str, alpha: float, quiet: bool, memory: int = 256000000):
+    """Frames are filtered by batches, as many as fit in `memory` bytes."""
     with utils.VideoInput(input_path) as vin:
+        batch_size = max(1, memory // (BYTES_PER_PIXEL * vin.width * vin.height))
+        batch = numpy.empty((batch_size, vin.height, vin.width, 3), dtype=numpy.uint8)
         with utils.VideoOutput(output_path, vin.width, vin.height, vin.framerate, vin.length, hide_progress=quiet) as vout:
+
+            def flush(n: int):
+                for frame_out in filter_frames(batch[:n], method, alpha):
+                    vout.feed(cv2.cvtColor(frame_out, cv2.COLOR_GRAY2RGB))
+
+            n = 0
             for frame_in in vin:
-                frame_out = filter_frame(frame_in, method, alpha)
-                vout.feed(cv2.cvtColor(frame_out, cv2.COLOR_GRAY2RGB))
+                batch[n] = frame_in
+                n += 1
+                if n == batch_size:
+                    flush(n)
+                    n = 0
+            if n > 0:
+                flush(n)
 
 
 def modulate_image(input_path: pathlib.Path, output_path: pathlib.Path, method: str, alpha: float):
@@ -74,16 +190,19 @@ class Modulate(OneToOneTool):
     def __init__(self,
             template: str,
             method: str,
-            alpha: float):
+            alpha: float,
+            memory: str = "256M"):
         OneToOneTool.__init__(self, template)
         self.method = method
         self.alpha = float(alpha)
+        self.memory = utils.parse_bytes(memory)
 
     @staticmethod
     def add_arguments(parser):
         OneToOneTool.add_arguments(parser)
         parser.add_argument("-m", "--method", type=str, default="outer", help="modulation operation to apply in the frequency space", choices=["outer", "inner", "scale", "random"])
         parser.add_argument("-a", "--alpha", type=float, default=0.01, help="modulation operation parameter")
+        parser.add_argument("-M", "--memory", type=str, default="256M", help="memory budget for video frames filtered in a single batch")
 
     def process(self, input_file: utils.InputFile) -> pathlib.Path:
         output_path = self.inflate(input_file.path, {
@@ -93,5 +212,5 @@ class Modulate(OneToOneTool):
         if input_file.path.suffix.lower() in [".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".webp", ".avif"]:
             modulate_image(input_file.path, output_path, self.method, self.alpha)
         else:
-            modulate_video(input_file.path, output_path, self.method, self.alpha, self.quiet)
+            modulate_video(input_file.path, output_path, self.method, self.alpha, self.quiet, self.memory)
         return output_path
@@ -1,4 +1,7 @@
+import concurrent.futures
+import os
 import pathlib
+import subprocess
 
 from ..tool import OneToOneTool
 from .. import utils
@@ -10,54 +13,77 @@ class Preview(OneToOneTool):
     DESC = "Extract thumbnails of evenly spaced moments of a video."
     OUTPUT_PATH_TEMPLATE = "{parent}/{stem}_preview.png"
 
-    def __init__(self, template: str, nrows: int = 3, ncols: int = 2):
+    def __init__(self, template: str, nrows: int = 3, ncols: int = 2, fast: bool = False, jobs: int = 0):
         OneToOneTool.__init__(self, template)
         self.nrows = nrows
         self.ncols = ncols
+        self.fast = fast
+        self.jobs = jobs
 
     @staticmethod
     def add_arguments(parser):
         OneToOneTool.add_arguments(parser)
         parser.add_argument("-r", "--nrows", type=int, default=3)
         parser.add_argument("-c", "--ncols", type=int, default=2)
+        parser.add_argument("-f", "--fast", action="store_true", help="take the keyframe preceding each moment instead of the exact frame, which only decodes one frame per thumbnail")
+        parser.add_argument("-j", "--jobs", type=int, default=0, help="number of thumbnails extracted concurrently (0 for one per CPU)")
 
-    def _extract_frames(self, input_path: pathlib.Path, folder: pathlib.Path):
+    def _extract_frame(self, input_path: pathlib.Path, timestamp: float):
+        """Decode the frame at a timestamp into memory, seeking to it."""
+        import io, PIL.Image
+        cmd = [
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel", "error",
+            *(["-skip_frame", "nokey", "-noaccurate_seek"] if self.fast else []),
+            "-ss", f"{timestamp:.6f}",
+            "-i", input_path.as_posix(),
+            "-an",
+            "-frames:v", "1",
+            "-f", "image2pipe",
+            "-c:v", "bmp",
+            "-"
+        ]
+        data = subprocess.run(cmd, stdout=subprocess.PIPE, check=True).stdout
+        if not data:
+            return None
+        with PIL.Image.open(io.BytesIO(data)) as image:
+            return image.convert("RGB")
+
+    def _extract_frames(self, input_path: pathlib.Path) -> list:
         probe = utils.ffprobe(input_path)
         npreviews = self.nrows * self.ncols
         if probe.duration is None:
             raise ValueError("Input video has no duration")
         frame_count = int(probe.duration * probe.framerate)
-        frame_indices = [i * (frame_count // npreviews) for i in range(npreviews)]
-        utils.ffmpeg(
-            "-i", input_path,
-            "-vf", "select='%s'" % ("+".join(["eq(n\\,%d)" % i for i in frame_indices])),
-            "-vsync", "0",
-            folder / "%06d.png",
-            show_stats=not self.quiet
-        )
-
-    def _merge_frames(self, folder: pathlib.Path, output_path: pathlib.Path):
+        timestamps = [i * (frame_count // npreviews) / probe.framerate for i in range(npreviews)]
+        jobs = min(self.jobs or os.cpu_count() or 1, npreviews)
+        with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+            return list(executor.map(lambda timestamp: self._extract_frame(input_path, timestamp), timestamps))
+
+    def _merge_frames(self, frames: list, output_path: pathlib.Path):
         import PIL.Image
         image = None
         width, height = None, None
-        for i, frame_path in enumerate(sorted(folder.glob("*.png"))):
-            with PIL.Image.open(frame_path, "r") as frame:
-                if image is None or width is None or height is None:
-                    width, height = frame.size
-                    image = PIL.Image.new(
-                        "RGB",
-                        (width * self.ncols, height * self.nrows),
-                        (0, 0, 0)
-                    )
-                row = i // self.ncols
-                col = i % self.ncols
-                image.paste(frame, (col * width, row * height))
-        assert image is not None
+        for i, frame in enumerate(frames):
+            if frame is None:
+                continue
+            if image is None or width is None or height is None:
+                width, height = frame.size
+                image = PIL.Image.new(
+                    "RGB",
+                    (width * self.ncols, height * self.nrows),
+                    (0, 0, 0)
+                )
+            row = i // self.ncols
+            col = i % self.ncols
+            image.paste(frame, (col * width, row * height))
+        if image is None:
+            raise ValueError("Could not extract any frame")
         image.save(output_path)
 
     def process(self, input_file: utils.InputFile) -> pathlib.Path:
-        with utils.tempdir() as folder:
-            self._extract_frames(input_file.path, folder)
-            ouptut_path = self.inflate(input_file.path)
-            self._merge_frames(folder, ouptut_path)
-        return ouptut_path
+        frames = self._extract_frames(input_file.path)
+        output_path = self.inflate(input_file.path)
+        self._merge_frames(frames, output_path)
+        return output_path
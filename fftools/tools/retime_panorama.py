@@ -1,4 +1,9 @@
+import bisect
+import concurrent.futures
+import inspect
+import itertools
 import math
+import os
 from pathlib import Path
 from typing import Tuple
 
@@ -6,7 +11,12 @@ import cv2
 import numpy
 
 from ..tool import OneToOneTool
-from ..utils import VideoInput, VideoOutput, InputFile
+from ..utils import VideoInput, VideoOutput, InputFile, keyframes, load_sidecar, sidecar_path
+
+
+# Minimum number of frames in a chunk of the motion analysis worth running in
+# its own process
+MIN_CHUNK_LENGTH = 250
 
 
 def moving_average(x: numpy.ndarray, radius: int) -> numpy.ndarray:
@@ -33,6 +43,47 @@ def enforce_monotonic(x: numpy.ndarray, increasing: bool) -> numpy.ndarray:
     return out
 
 
+def analysis_frame(frame: numpy.ndarray, levels: int) -> numpy.ndarray:
+    """Gray version of an RGB frame, downscaled `levels` times by 2."""
+    gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+    for _ in range(levels):
+        gray = cv2.pyrDown(gray)
+    return gray
+
+
+def analysis_levels(width: int, max_width: int) -> int:
+    """Number of pyramid levels to go down for frames to fit in `max_width`."""
+    levels = 0
+    while max_width > 0 and width > max_width:
+        width = (width + 1) // 2
+        levels += 1
+    return levels
+
+
+def replenish_tracks(gray: numpy.ndarray, points: numpy.ndarray | None, max_corners: int, quality_level: float, min_distance: float) -> numpy.ndarray | None:
+    """Add new corners to tracked points, away from the existing ones."""
+    mask = numpy.full(gray.shape, 255, dtype=numpy.uint8)
+    count = 0
+    if points is not None:
+        count = len(points)
+        for x, y in points.reshape(-1, 2):
+            cv2.circle(mask, (int(x), int(y)), int(min_distance), 0, -1)
+    if count >= max_corners:
+        return points
+    new = cv2.goodFeaturesToTrack(
+        gray,
+        mask=mask,
+        maxCorners=max_corners - count,
+        qualityLevel=quality_level,
+        minDistance=min_distance,
+        blockSize=3)
+    if new is None:
+        return points
+    if points is None:
+        return new
+    return numpy.concatenate([points, new]).astype(numpy.float32)
+
+
 def estimate_motion(
         vin: VideoInput,
         max_corners=800,
@@ -41,65 +92,202 @@ def estimate_motion(
         win_size=(21, 21),
         max_level=3,
         ransac_thresh=3.0,
+        min_tracks=400,
+        max_width=640,
+        start=0,
+        stop=None,
         ) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
-    if vin.length < 2:
+    """Estimate the translation between consecutive frames. Corners are
+    tracked from frame to frame with Lucas-Kanade optical flow, and only
+    detected again when less than `min_tracks` of them survive. Analysis is
+    done on frames downscaled to at most `max_width` pixels (distance
+    parameters apply at this scale); translations are given at full scale.
+    Only frames `start` to `stop` (excluded) are analysed.
+    """
+    stop = vin.length if stop is None else stop
+    if stop - start < 2:
         raise ValueError("Video is too short (need at least 2 frames).")
-    prev = vin.at(0)
-    prev_gray = cv2.cvtColor(prev, cv2.COLOR_BGR2GRAY)
-    dx = numpy.zeros(vin.length - 1, dtype=numpy.float32)
-    dy = numpy.zeros(vin.length - 1, dtype=numpy.float32)
-    valid = numpy.zeros(vin.length - 1, dtype=numpy.bool_)
-    for i in range(1, vin.length):
+    levels = analysis_levels(vin.width, max_width)
+    prev_gray = analysis_frame(vin.at(start), levels)
+    factor = vin.width / prev_gray.shape[1]
+    height, width = prev_gray.shape
+    dx = numpy.zeros(stop - start - 1, dtype=numpy.float32)
+    dy = numpy.zeros(stop - start - 1, dtype=numpy.float32)
+    valid = numpy.zeros(stop - start - 1, dtype=numpy.bool_)
+    p0 = None
+    for i in range(stop - start - 1):
         try:
             curr = next(vin)
         except StopIteration:
             break
-        curr_gray = cv2.cvtColor(curr, cv2.COLOR_RGB2GRAY)
-        p0 = cv2.goodFeaturesToTrack(
-            prev_gray,
-            mask=None,
-            maxCorners=max_corners,
-            qualityLevel=quality_level,
-            minDistance=min_distance,
-            blockSize=3)
+        curr_gray = analysis_frame(curr, levels)
+        if p0 is None or len(p0) < min_tracks:
+            p0 = replenish_tracks(prev_gray, p0, max_corners, quality_level, min_distance)
         if p0 is None or len(p0) < 10:
             prev_gray = curr_gray
+            p0 = None
             continue
-        p1 = p0.copy()
         p1, st, err = cv2.calcOpticalFlowPyrLK(
             prev_gray,
             curr_gray,
             p0,
-            p1,
-            None,
             None,
             winSize=win_size,
             maxLevel=max_level,
             criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 30, 0.01)
         )
+        prev_gray = curr_gray
         if p1 is None:
-            prev_gray = curr_gray
+            p0 = None
             continue
         st = st.reshape(-1) > 0
         p0v = p0.reshape(-1, 2)[st]
         p1v = p1.reshape(-1, 2)[st]
         if len(p0v) < 10:
-            prev_gray = curr_gray
+            p0 = None
             continue
-        M, inliers = cv2.estimateAffinePartial2D(p0v, p1v, method=cv2.RANSAC, ransacReprojThreshold=ransac_thresh)
+        M, inliers = cv2.estimateAffinePartial2D(p0v, p1v, method=cv2.RANSAC, ransacReprojThreshold=ransac_thresh / factor)
         if M is None:
             d = p1v - p0v
-            dx[i - 1] = numpy.median(d[:, 0])
-            dy[i - 1] = numpy.median(d[:, 1])
-            valid[i - 1] = True
+            dx[i] = numpy.median(d[:, 0]) * factor
+            dy[i] = numpy.median(d[:, 1]) * factor
+            valid[i] = True
         else:
-            dx[i - 1] = M[0, 2]
-            dy[i - 1] = M[1, 2]
-            valid[i - 1] = True
+            dx[i] = M[0, 2] * factor
+            dy[i] = M[1, 2] * factor
+            valid[i] = True
+            p1v = p1v[inliers.reshape(-1) > 0]
+        inside = (p1v[:, 0] >= 0) & (p1v[:, 0] < width) & (p1v[:, 1] >= 0) & (p1v[:, 1] < height)
+        p0 = p1v[inside].reshape(-1, 1, 2)
+    return dx, dy, valid
+
+
+def estimate_motion_phase(
+        vin: VideoInput,
+        max_width=640,
+        min_response=0.05,
+        start=0,
+        stop=None,
+        ) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    """Estimate the translation between consecutive frames with phase
+    correlation on downscaled luma, windowed by a Hanning window. Shifts
+    whose correlation peak is below `min_response` are marked invalid. Only
+    frames `start` to `stop` (excluded) are analysed.
+    """
+    stop = vin.length if stop is None else stop
+    if stop - start < 2:
+        raise ValueError("Video is too short (need at least 2 frames).")
+    levels = analysis_levels(vin.width, max_width)
+    prev_gray = analysis_frame(vin.at(start), levels).astype(numpy.float32)
+    factor = vin.width / prev_gray.shape[1]
+    window = cv2.createHanningWindow(prev_gray.shape[::-1], cv2.CV_32F)
+    dx = numpy.zeros(stop - start - 1, dtype=numpy.float32)
+    dy = numpy.zeros(stop - start - 1, dtype=numpy.float32)
+    valid = numpy.zeros(stop - start - 1, dtype=numpy.bool_)
+    for i in range(stop - start - 1):
+        try:
+            curr = next(vin)
+        except StopIteration:
+            break
+        curr_gray = analysis_frame(curr, levels).astype(numpy.float32)
+        (shift_x, shift_y), response = cv2.phaseCorrelate(prev_gray, curr_gray, window)
+        dx[i] = shift_x * factor
+        dy[i] = shift_y * factor
+        valid[i] = response >= min_response
         prev_gray = curr_gray
     return dx, dy, valid
 
 
+MOTION_ESTIMATORS = {
+    "features": estimate_motion,
+    "phase": estimate_motion_phase,
+}
+
+
+def analyse_chunk(path: Path, motion: str, start: int, stop: int) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    """Motion between frames `start` to `stop` (excluded), in a worker."""
+    cv2.setNumThreads(1)
+    with VideoInput(path) as vin:
+        return MOTION_ESTIMATORS[motion](vin, start=start, stop=stop)
+
+
+def chunk_bounds(length: int, count: int, keys: list[int]) -> list[int]:
+    """Split frames 0 to `length - 1` in at most `count` chunks sharing their
+    boundary frame, with boundaries moved to the nearest keyframes (if any),
+    so that workers seek to them without decoding extra frames.
+    """
+    bounds = [0]
+    for k in range(1, count):
+        b = round(k * (length - 1) / count)
+        j = bisect.bisect_left(keys, b)
+        candidates = [key for key in keys[max(0, j - 1):j + 1] if 0 < key < length - 1]
+        if candidates:
+            b = min(candidates, key=lambda key: abs(key - b))
+        if b > bounds[-1]:
+            bounds.append(b)
+    bounds.append(length - 1)
+    return bounds
+
+
+def analyse_motion(path: Path, length: int, motion: str = "features", jobs: int = 0) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    """Estimate motion between consecutive frames of a video, in chunks
+    analysed by up to `jobs` processes (0 for one per CPU). Chunks overlap by
+    one frame, so their results are simply concatenated.
+    """
+    count = min(jobs or os.cpu_count() or 1, length // MIN_CHUNK_LENGTH)
+    if count <= 1:
+        with VideoInput(path) as vin:
+            return MOTION_ESTIMATORS[motion](vin)
+    bounds = chunk_bounds(length, count, keyframes(path))
+    with concurrent.futures.ProcessPoolExecutor(len(bounds) - 1) as executor:
+        results = list(executor.map(
+            analyse_chunk,
+            itertools.repeat(path),
+            itertools.repeat(motion),
+            bounds[:-1],
+            [b + 1 for b in bounds[1:]]))
+    dx, dy, valid = (numpy.concatenate(arrays) for arrays in zip(*results))
+    return dx, dy, valid
+
+
+def motion_path(input_path: Path) -> Path:
+    return sidecar_path(input_path, ".motion.npz")
+
+
+def estimator_parameters(motion: str) -> dict:
+    """Name and default parameters of a motion estimator, identifying the
+    analyses it produces.
+    """
+    parameters = {
+        name: parameter.default
+        for name, parameter in inspect.signature(MOTION_ESTIMATORS[motion]).parameters.items()
+        if name not in ["vin", "start", "stop"]
+    }
+    return {"motion": motion, **parameters}
+
+
+def load_motion(
+        input_path: Path,
+        length: int,
+        motion: str = "features",
+        jobs: int = 0,
+        analyse: bool = True,
+        ) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    """Motion analysis of a video, cached in a sidecar file. If `analyse` is
+    False, a missing or outdated analysis is an error instead.
+    """
+    path = motion_path(input_path)
+
+    def compute() -> dict:
+        if not analyse:
+            raise ValueError(f"No motion analysis of {input_path} with these parameters was found at {path}")
+        dx, dy, valid = analyse_motion(input_path, length, motion, jobs)
+        return {"dx": dx, "dy": dy, "valid": valid}
+
+    data = load_sidecar(path, input_path, estimator_parameters(motion), compute)
+    return data["dx"], data["dy"], data["valid"]
+
+
 def build_cumulative_path(dx: numpy.ndarray, dy: numpy.ndarray, valid: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
     dx2 = dx.copy()
     dy2 = dy.copy()
@@ -130,6 +318,44 @@ def remap_indices_to_constant_speed(pos: numpy.ndarray) -> numpy.ndarray:
     return src_idx.astype(numpy.float32)
 
 
+class FrameWindow:
+    """Access frames of a video by non-decreasing indices with a sequential
+    decode, keeping the last two decoded frames. Jumps of more than
+    `max_skip` frames forward, or any jump backward, seek instead.
+    """
+
+    def __init__(self, vin: VideoInput, max_skip: int = 32):
+        self.vin = vin
+        self.max_skip = max_skip
+        self.index = -1
+        self.current = None
+        self.previous = None
+        self.vin.rewind()
+
+    def __getitem__(self, j: int) -> numpy.ndarray:
+        if j == self.index - 1 and self.previous is not None:
+            return self.previous
+        if j < self.index or j > self.index + self.max_skip:
+            self.previous = None
+            self.current = self.vin.at(j)
+            self.index = j
+        while self.index < j:
+            try:
+                frame = next(self.vin)
+            except StopIteration:
+                # Decoding ended early (eg. the frame count was overestimated):
+                # seek like `vin.at` would, rather than return another frame
+                self.previous = None
+                self.current = self.vin.at(j)
+                self.index = j
+                break
+            self.previous = self.current
+            self.current = frame
+            self.index += 1
+        assert self.current is not None
+        return self.current
+
+
 class RetimePanorama(OneToOneTool):
 
     NAME = "retime-panorama"
@@ -138,19 +364,40 @@ class RetimePanorama(OneToOneTool):
 
     def __init__(self,
             template: str,
-            radius: int):
+            radius: int,
+            motion: str = "features",
+            jobs: int = 0,
+            cache: bool = False,
+            analyse_only: bool = False,
+            render_only: bool = False):
         OneToOneTool.__init__(self, template)
         self.radius = radius
+        self.motion = motion
+        self.jobs = jobs
+        self.cache = cache or analyse_only or render_only
+        self.analyse_only = analyse_only
+        self.render_only = render_only
 
     @staticmethod
     def add_arguments(parser):
         OneToOneTool.add_arguments(parser)
         parser.add_argument("-r", "--radius", type=int, default=1, help="Moving-average radius (in frames) for trajectory")
+        parser.add_argument("-m", "--motion", type=str, default="features", choices=["features", "phase"], help="motion estimator: feature tracking, or phase correlation (faster, for purely translational motion)")
+        parser.add_argument("-j", "--jobs", type=int, default=0, help="number of processes for motion analysis (0 for one per CPU)")
+        parser.add_argument("-c", "--cache", action="store_true", help="store the motion analysis next to the input (as <input>.motion.npz) and reuse it in later runs with the same motion estimator, eg. to try other radii")
+        group = parser.add_mutually_exclusive_group()
+        group.add_argument("--analyse-only", action="store_true", help="only analyse motion and cache it, without rendering (implies --cache)")
+        group.add_argument("--render-only", action="store_true", help="only render, from a cached motion analysis (implies --cache)")
 
-    def process(self, input_file: InputFile) -> Path:
-        output_path = self.inflate(input_file.path, {"radius": self.radius})
+    def process(self, input_file: InputFile) -> Path | None:
         with VideoInput(input_file.path) as vin:
-            dx, dy, valid = estimate_motion(vin)
+            if self.cache:
+                dx, dy, valid = load_motion(input_file.path, vin.length, self.motion, self.jobs, analyse=not self.render_only)
+            else:
+                dx, dy, valid = analyse_motion(input_file.path, vin.length, self.motion, self.jobs)
+            if self.analyse_only:
+                return None
+            output_path = self.inflate(input_file.path, {"radius": self.radius})
             x, y = build_cumulative_path(dx, dy, valid)
             axis = decide_axis(x, y)
             pos = x if axis == "x" else y
@@ -158,6 +405,7 @@ class RetimePanorama(OneToOneTool):
             increasing = pos_sm[-1] >= pos_sm[0]
             pos_mono = enforce_monotonic(pos_sm, increasing=increasing)
             src_idx = remap_indices_to_constant_speed(pos_mono)
+            window = FrameWindow(vin)
             with VideoOutput(output_path, vin.width, vin.height, vin.framerate, vin.length, hide_progress=self.quiet) as vout:
                 for i in range(vin.length):
                     t = src_idx[i]
@@ -165,10 +413,10 @@ class RetimePanorama(OneToOneTool):
                     j1 = int(numpy.clip(j0 + 1, 0, vin.length - 1))
                     alpha = float(t - j0)
                     if j0 == j1:
-                        frame = vin.at(j0)
+                        frame = window[j0]
                     else:
-                        f0 = vin.at(j0)
-                        f1 = vin.at(j1)
+                        f0 = window[j0]
+                        f1 = window[j1]
                         frame = cv2.addWeighted(f0, 1.0 - alpha, f1, alpha, 0.0)
                     vout.feed(frame)
         return output_path
@@ -1,5 +1,5 @@
-import os
 import pathlib
+import subprocess
 
 from ..tool import OneToOneTool
 from .. import utils
@@ -10,67 +10,213 @@ class Scenes(OneToOneTool):
     NAME = "scenes"
     DESC = "Extract a thumbnail of every different scene in a video."
     OUTPUT_PATH_TEMPLATE = "{parent}/{stem}-scenes"
+    ANALYSIS_SIZE = (160, 90) # frames are compared at this resolution
+    ROLLING_WINDOW = 30 # number of previous frame differences a cut is compared to
+    ROLLING_RATIO = 3 # how much larger than their mean a cut difference must be
 
     def __init__(self,
             template: str,
             bin_width: int = 10,
-            threshold: float = 0.002):
+            threshold: float = 0.002,
+            all_frames: bool = False,
+            min_length: int = 15):
         OneToOneTool.__init__(self, template)
         self.bin_width = bin_width
         self.threshold = threshold
+        self.all_frames = all_frames
+        self.min_length = min_length
 
     @staticmethod
     def add_arguments(parser):
         OneToOneTool.add_arguments(parser)
         parser.add_argument("-b", "--bin-width", type=int, default=10)
         parser.add_argument("-t", "--threshold", type=float, default=0.002)
-    
-    def _extract_keyframes(self, input_path: pathlib.Path, output_path: pathlib.Path):
-        utils.ffmpeg(
-            "-skip_frame", "nokey",
-            "-i", input_path,
+        parser.add_argument("-a", "--all-frames", action="store_true", help="detect cuts on every frame instead of keyframes only, and store the scene index next to the input (as <input>.scenes.json) for later runs and other tools")
+        parser.add_argument("-l", "--min-length", type=int, default=15, help="minimum scene length, in frames, with --all-frames")
+
+    def _read_frames(self, input_path: pathlib.Path, keyframes_only: bool = True):
+        """Decode the frames (or keyframes only) of a video, downscaled to
+        `ANALYSIS_SIZE`, through a rawvideo pipe. FFmpeg errors are printed
+        and raise a `subprocess.CalledProcessError` once the pipe is closed.
+        """
+        import numpy
+        width, height = self.ANALYSIS_SIZE
+        cmd = [
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel", "error",
+            *(["-skip_frame", "nokey"] if keyframes_only else []),
+            "-i", input_path.as_posix(),
+            "-an",
+            "-vf", f"scale={width}:{height}:flags=area",
             "-vsync", "vfr",
-            "-frame_pts", "true",
-            output_path / "%06d.png",
-            show_stats=not self.quiet
-        )
-    
-    def _load_frame(self, image_path: pathlib.Path):
-        import numpy, PIL.Image
-        bins = list(range(0, 256, self.bin_width))
-        with PIL.Image.open(image_path) as file:
-            arr = numpy.array(file)
-        r = numpy.histogram(numpy.ravel(arr[:,:,0]), bins=bins, density=True)[0]
-        g = numpy.histogram(numpy.ravel(arr[:,:,1]), bins=bins, density=True)[0]
-        b = numpy.histogram(numpy.ravel(arr[:,:,2]), bins=bins, density=True)[0]
-        return numpy.stack([r, g, b])
-    
+            "-f", "rawvideo",
+            "-pix_fmt", "rgb24",
+            "-"
+        ]
+        frame_size = width * height * 3
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        assert process.stdout is not None
+        try:
+            while True:
+                data = process.stdout.read(frame_size)
+                if len(data) < frame_size:
+                    break
+                yield numpy.frombuffer(data, dtype=numpy.uint8).reshape(height, width, 3)
+        finally:
+            process.stdout.close()
+            process.wait()
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd)
+
+    def _histogram_codes(self):
+        """Lookup table from a pixel value to its histogram bin, with the bins
+        of `numpy.histogram` over edges 0, bin_width, 2 * bin_width... below
+        256 (the last bin includes its upper edge, values above it go to an
+        extra bin that is discarded).
+        """
+        import numpy
+        edges = numpy.arange(0, 256, self.bin_width)
+        nbins = len(edges) - 1
+        lut = numpy.minimum(numpy.arange(256) // self.bin_width, nbins)
+        lut[edges[-1]] = nbins - 1
+        return lut.astype(numpy.intp), nbins
+
+    def _histograms(self, frame, lut, nbins: int):
+        """Per-channel histogram densities of a frame, as one bincount."""
+        import numpy
+        codes = lut[frame] + numpy.arange(3) * (nbins + 1)
+        counts = numpy.bincount(codes.ravel(), minlength=3 * (nbins + 1)).reshape(3, nbins + 1)[:, :nbins]
+        return counts / (numpy.maximum(counts.sum(axis=1, keepdims=True), 1) * self.bin_width)
+
     def _frame_comparator(self, left, right) -> bool:
         import numpy
         diff = numpy.average(numpy.abs(left - right))
         return diff < self.threshold
-    
-    def _delete_duplicates(self, output_path: pathlib.Path):
+
+    def _select_keyframes(self, input_path: pathlib.Path) -> tuple[list[int], int]:
+        """Indices of the keyframes starting a new scene, and the number of
+        keyframes.
+        """
         import tqdm
-        paths = sorted(output_path.glob("*.png"))
-        frame_count = len(paths)
-        removed_count = 0
-        if not paths:
-            return
-        current_frame = self._load_frame(paths.pop(0))
-        for path in tqdm.tqdm(paths, desc="Removing duplicates", disable=self.quiet):
-            next_frame = self._load_frame(path)
-            if self._frame_comparator(current_frame, next_frame):
-                os.remove(path)
-                removed_count += 1
+        lut, nbins = self._histogram_codes()
+        selected = []
+        current = None
+        count = 0
+        for i, frame in enumerate(tqdm.tqdm(self._read_frames(input_path), desc="Comparing keyframes", unit="frame", disable=self.quiet)):
+            histograms = self._histograms(frame, lut, nbins)
+            count += 1
+            if current is None or not self._frame_comparator(current, histograms):
+                selected.append(i)
+                current = histograms
+        return selected, count
+
+    def _detect_cuts(self, input_path: pathlib.Path) -> list[dict]:
+        """Go through every frame of a video and split it in scenes, where
+        the histogram difference between consecutive frames is above the
+        threshold and much above its rolling mean. Return the first frame
+        index, length and statistics of every scene.
+        """
+        import collections, numpy, tqdm
+        lut, nbins = self._histogram_codes()
+        differences = collections.deque(maxlen=self.ROLLING_WINDOW)
+        scenes = []
+        previous = None
+        for i, frame in enumerate(tqdm.tqdm(self._read_frames(input_path, keyframes_only=False), desc="Detecting cuts", unit="frame", disable=self.quiet)):
+            histograms = self._histograms(frame, lut, nbins)
+            difference = 0.0
+            if previous is not None:
+                difference = float(numpy.average(numpy.abs(histograms - previous)))
+            previous = histograms
+            if not scenes or (difference >= self.threshold
+                    and difference > self.ROLLING_RATIO * sum(differences) / max(1, len(differences))
+                    and scenes[-1]["length"] >= self.min_length):
+                scenes.append({"frame": i, "length": 0, "luma": 0.0, "difference": 0.0})
+                differences.clear()
             else:
-                current_frame = next_frame
-        if not self.quiet:
-            print("Removed", removed_count, "of", frame_count, "frames")
-    
+                differences.append(difference)
+                scenes[-1]["difference"] += difference
+            scenes[-1]["length"] += 1
+            scenes[-1]["luma"] += float(frame.mean()) / 255
+        for scene in scenes:
+            scene["luma"] /= scene["length"]
+            scene["difference"] /= max(1, scene["length"] - 1)
+        return scenes
+
+    def _index_scenes(self, input_path: pathlib.Path) -> dict:
+        """Number of frames and scenes of a video, for its scene index."""
+        scenes = self._detect_cuts(input_path)
+        times = [pts_time for _, pts_time, _ in utils.probe_packets(input_path)]
+        frames = sum(scene["length"] for scene in scenes)
+        # Frames past the probed packets are extrapolated from their timing
+        if len(times) > 1:
+            origin, step = times[0], (times[-1] - times[0]) / (len(times) - 1)
+        else:
+            origin, step = (times[0] if times else 0.0), 1 / utils.ffprobe(input_path).framerate
+
+        def time_of(frame: int) -> float:
+            return times[frame] if frame < len(times) else origin + frame * step
+
+        for scene in scenes:
+            scene["time"] = time_of(scene["frame"])
+            scene["duration"] = time_of(scene["frame"] + scene["length"]) - scene["time"]
+        return {
+            "frames": frames,
+            "scenes": [{key: scene[key] for key in ["frame", "time", "length", "duration", "luma", "difference"]} for scene in scenes],
+        }
+
+    def _load_scene_index(self, input_path: pathlib.Path) -> dict:
+        parameters = {"bin_width": self.bin_width, "threshold": self.threshold, "min_length": self.min_length}
+        return utils.load_sidecar(scene_index_path(input_path), input_path, parameters, lambda: self._index_scenes(input_path))
+
+    def _extract_frame(self, input_path: pathlib.Path, pts_time: float, path: pathlib.Path, keyframe: bool = True):
+        """Write the frame at a timestamp, seeking straight to it if it is a
+        keyframe, or decoding from the previous keyframe otherwise.
+        """
+        if keyframe:
+            seek = ["-noaccurate_seek", "-ss", f"{pts_time + 0.001:.6f}"]
+        else:
+            seek = ["-ss", f"{max(0, pts_time - 0.0005):.6f}"]
+        utils.ffmpeg(
+            "-seek_timestamp", "1",
+            *seek,
+            "-i", input_path,
+            "-frames:v", "1",
+            path,
+            show_stats=False
+        )
+
     def process(self, input_file: utils.InputFile) -> pathlib.Path:
+        import tqdm
         output_path = self.inflate(input_file.path)
         output_path.mkdir(exist_ok=True)
-        self._extract_keyframes(input_file.path, output_path)
-        self._delete_duplicates(output_path)
+        if self.all_frames:
+            index = self._load_scene_index(input_file.path)
+            for scene in tqdm.tqdm(index["scenes"], desc="Extracting scenes", unit="frame", disable=self.quiet):
+                self._extract_frame(input_file.path, scene["time"], output_path / f"{scene['frame']:06d}.png", keyframe=False)
+            if not self.quiet:
+                print("Found", len(index["scenes"]), "scenes in", index["frames"], "frames")
+            return output_path
+        selected, count = self._select_keyframes(input_file.path)
+        keys = [(index, pts_time) for index, (_, pts_time, key) in enumerate(utils.probe_packets(input_file.path)) if key]
+        for i in tqdm.tqdm(selected, desc="Extracting scenes", unit="frame", disable=self.quiet):
+            if i < len(keys):
+                index, pts_time = keys[i]
+                self._extract_frame(input_file.path, pts_time, output_path / f"{index:06d}.png")
+        if not self.quiet:
+            print("Removed", count - len(selected), "of", count, "frames")
         return output_path
+
+
+def scene_index_path(input_path: pathlib.Path) -> pathlib.Path:
+    return utils.sidecar_path(input_path, ".scenes.json")
+
+
+def load_scene_index(input_path: pathlib.Path) -> dict | None:
+    """Scene index of a video stored by `scenes --all-frames`, if it is up to
+    date. It holds the detection "parameters", the number of "frames" and
+    the list of "scenes", each with its first "frame" index and presentation
+    "time", its "length" in frames, its "duration" in seconds, its mean
+    "luma" and its mean "difference" between consecutive frames.
+    """
+    return utils.read_sidecar(scene_index_path(input_path), input_path)
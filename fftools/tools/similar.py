@@ -0,0 +1,129 @@
+import argparse
+import concurrent.futures
+import itertools
+import os
+import pathlib
+
+from ..tool import Tool
+from .. import utils
+
+
+def hash_file(path: pathlib.Path, method: str, samples: int) -> tuple[list[int], list[int]]:
+    """Frame indices and perceptual hashes of the sampled frames of a file:
+    the image itself, the first frame of each scene of a video if it has a
+    scene index (see `scenes --all-frames`), or evenly spaced frames.
+    """
+    import cv2, numpy
+    from .. import hashing
+    from .scenes import load_scene_index
+    function = hashing.HASH_FUNCTIONS[method]
+    if utils.is_image(path):
+        gray = cv2.imread(path.as_posix(), cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            return [], []
+        return [0], [function(gray)]
+    frames, hashes = [], []
+    with utils.VideoInput(path) as vin:
+        index = load_scene_index(path)
+        if index is not None:
+            indices = [scene["frame"] for scene in index["scenes"]]
+        else:
+            indices = numpy.unique(numpy.linspace(0, max(0, vin.length - 1), samples).astype(int)).tolist()
+        for i in indices:
+            try:
+                frame = vin.at(i)
+            except StopIteration:
+                continue
+            frames.append(i)
+            hashes.append(function(cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)))
+    return frames, hashes
+
+
+class Similar(Tool):
+
+    NAME = "similar"
+    DESC = "Find near-duplicate images and video shots across a media "\
+        "library, by comparing perceptual hashes of sampled frames. Hashes "\
+        "are stored in an index file, and only new or modified files are "\
+        "hashed again."
+
+    def __init__(self,
+            index_path: str,
+            input_paths: list[str] | None = None,
+            query: list[str] | None = None,
+            method: str = "dhash",
+            samples: int = 8,
+            distance: int = 10,
+            jobs: int = 0,
+            quiet: bool = False):
+        Tool.__init__(self, quiet)
+        self.index_path = pathlib.Path(index_path)
+        self.input_paths = input_paths or []
+        self.query = query
+        self.method = method
+        self.samples = samples
+        self.distance = distance
+        self.jobs = jobs
+
+    @staticmethod
+    def add_arguments(parser: argparse.ArgumentParser):
+        parser.add_argument("index_path", type=str, help="path to the index file (.npz)")
+        parser.add_argument("input_paths", type=str, nargs="*", help="media files or folders to add to the index")
+        parser.add_argument("-q", "--query", type=str, nargs="+", default=None, help="media files to look for in the index, instead of listing all near-duplicates within it")
+        parser.add_argument("-m", "--method", type=str, default="dhash", choices=["dhash", "phash"], help="perceptual hash (changing it rebuilds the index)")
+        parser.add_argument("-s", "--samples", type=int, default=8, help="number of frames hashed per video without a scene index")
+        parser.add_argument("-d", "--distance", type=int, default=10, help="maximum Hamming distance between hashes (out of 64 bits) of similar frames")
+        parser.add_argument("-j", "--jobs", type=int, default=0, help="number of processes for hashing (0 for one per CPU)")
+        parser.add_argument("-Q", "--quiet", action="store_true", help="do not print progress")
+
+    @classmethod
+    def run_from_args(cls, args: argparse.Namespace):
+        cls(**vars(args)).run()
+
+    def hash_files(self, paths: list[pathlib.Path]):
+        """Hashes of files, computed by up to `jobs` processes."""
+        import tqdm
+        jobs = min(self.jobs or os.cpu_count() or 1, len(paths))
+        if jobs <= 1:
+            results = map(hash_file, paths, itertools.repeat(self.method), itertools.repeat(self.samples))
+            yield from tqdm.tqdm(results, total=len(paths), unit="file", disable=self.quiet)
+            return
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            results = executor.map(hash_file, paths, itertools.repeat(self.method), itertools.repeat(self.samples))
+            yield from tqdm.tqdm(results, total=len(paths), unit="file", disable=self.quiet)
+
+    def update(self, library):
+        """Hash the new and modified input files and drop the missing ones."""
+        for file in list(library.files):
+            if not pathlib.Path(file).exists():
+                library.remove(file)
+        paths = []
+        fingerprints = []
+        if self.input_paths:
+            for input_file in utils.expand_paths(self.input_paths, sort=True):
+                path = input_file.path.absolute()
+                if not (utils.is_image(path) or utils.is_video(path)):
+                    continue
+                fingerprint = utils.fingerprint(path)
+                if not library.is_current(path.as_posix(), fingerprint):
+                    paths.append(path)
+                    fingerprints.append(fingerprint)
+        for path, fingerprint, (frames, hashes) in zip(paths, fingerprints, self.hash_files(paths)):
+            library.add(path.as_posix(), fingerprint, frames, hashes)
+        if not self.quiet:
+            print(f"Hashed {len(paths)} files, {len(library.files)} in the index")
+
+    def run(self):
+        from ..hashing import HashLibrary
+        library = HashLibrary.load(self.index_path, self.method)
+        self.update(library)
+        library.save(self.index_path)
+        if self.query is None:
+            for distance, file_a, frame_a, file_b, frame_b in library.duplicates(self.distance):
+                print(distance, file_a, frame_a, file_b, frame_b, sep="\t")
+            return
+        queries = [input_file.path for input_file in utils.expand_paths(self.query, sort=True)]
+        for path, (frames, hashes) in zip(queries, self.hash_files(queries)):
+            for frame, query in zip(frames, hashes):
+                for distance, file, match in library.search(query, self.distance):
+                    print(distance, path.as_posix(), frame, file, match, sep="\t")
@@ -1,6 +1,7 @@
 import pathlib
 import random
 
+import cv2
 import numpy
 
 from ..tool import OneToOneTool
@@ -12,6 +13,7 @@ class Squeeze(OneToOneTool):
     NAME = "squeeze"
     DESC = "Vertically squeeze a video with an irregular shape."
     OUTPUT_PATH_TEMPLATE = "{parent}/{stem}_squeeze_o{octaves}_r{resolution}_a{amplitude}_s{speed}_p{pad_start}_l{parallel}_d{duplication}_e{seed}{suffix}"
+    CHUNK_SIZE = 256 # number of output frames whose envelopes are computed at once
 
     def __init__(self,
             template: str,
@@ -68,56 +70,57 @@ class Squeeze(OneToOneTool):
         seeds = (seeds * 0x85EBCA6B) & 0xFFFFFFFF
         return (seeds / 0xFFFFFFFF).astype(numpy.float32) * 2 - 1
 
-    def squeeze(self,
-            frame: numpy.ndarray,
-            input_length: int,
-            input_frame_index: int,
-            duplication_index: int,
+    def envelopes(self,
+            t: numpy.ndarray,
+            output_length: int,
             width: int,
-            height: int) -> numpy.ndarray:
-        output_length = input_length * self.duplication
+            height: int) -> tuple[numpy.ndarray, numpy.ndarray]:
+        """Return the top and bottom rows of the envelope for output frames
+        `t`, as arrays of shape (len(t), width).
+        """
         pad_start = output_length * self.pad_start
         pad_length = output_length * (self.pad_start + self.pad_end)
-        j = numpy.arange(width)
-        t = input_frame_index * self.duplication + duplication_index
+        j = numpy.arange(width)[numpy.newaxis, :]
+        t = t[:, numpy.newaxis]
+        shape = (t.shape[0], width)
         if self.parallel:
-            top = (t - pad_start) / (output_length - pad_length) * height / 2
-            bottom = height - (t - pad_start) / (output_length - pad_length) * height / 2
+            progress = (t - pad_start) / (output_length - pad_length) * height / 2
         else:
-            top = ((t - pad_start) + j / self.speed) / (output_length - pad_length) * height / 2
-            bottom = height - ((t - pad_start) + j / self.speed) / (output_length - pad_length) * height / 2
+            progress = ((t - pad_start) + j / self.speed) / (output_length - pad_length) * height / 2
+        top = numpy.empty(shape)
+        top[:] = progress
+        bottom = numpy.empty(shape)
+        bottom[:] = height - progress
+        offset = int(output_length * self.speed)
         x = (j + self.speed * t) * self.resolution
         for octave in range(self.octaves):
             x_scaled = x * (2 ** octave)
-            j_left = numpy.floor(x_scaled).astype(int)
-            j_right = j_left + 1
+            j_left = numpy.floor(x_scaled).astype(numpy.int64)
             z = x_scaled - j_left
             smoothstep = 3 * z ** 2 - 2 * z ** 3
-            slope_a = self.slopes(j_left * self.octaves + octave)
-            slope_b = self.slopes(j_right * self.octaves + octave)
-            ya = slope_a * smoothstep
-            yb = slope_b * (smoothstep - 1)
-            top += self.amplitude * 2 ** (-octave) * ((1 - smoothstep) * ya + smoothstep * yb)
-            slope_a = self.slopes(j_left * self.octaves + octave + output_length * self.speed)
-            slope_b = self.slopes(j_right * self.octaves + octave + output_length * self.speed)
-            ya = numpy.multiply(slope_a, smoothstep)
-            yb = numpy.multiply(slope_b, (smoothstep - 1))
-            bottom += self.amplitude * 2 ** (-octave) * ((1 - smoothstep) * ya + smoothstep * yb)
+            for envelope, base in [(top, 0), (bottom, offset)]:
+                ya = self.slopes(j_left * self.octaves + octave + base) * smoothstep
+                yb = self.slopes((j_left + 1) * self.octaves + octave + base) * (smoothstep - 1)
+                envelope += self.amplitude * 2 ** (-octave) * ((1 - smoothstep) * ya + smoothstep * yb)
         imin = numpy.clip(numpy.floor(top), 0, height - 1).astype(int)
         imax = numpy.clip(numpy.floor(bottom), 0, height - 1).astype(int)
-        X = numpy.indices((height, width)).transpose(1, 2, 0)
+        return imin, imax
+
+    def warp_parameters(self,
+            t: numpy.ndarray,
+            output_length: int,
+            width: int,
+            height: int) -> tuple[numpy.ndarray, numpy.ndarray]:
+        """Output row i of column j of frame t comes from input row
+        floor((i - start[t, j]) * scale[t, j]), or is black if outside of the
+        frame. Columns where the envelope is closed are moved out of it.
+        """
+        imin, imax = self.envelopes(t, output_length, width, height)
         diff = imax - imin
-        where = numpy.where(diff > 0)
-        X[:,where,0] = numpy.divide(X[:,where,0] - imin[where], diff[where]) * height
-        mask_diff = diff <= 0
-        mask_above = X[..., 0] < 0
-        mask_below = X[..., 0] >= height
-        X[:,:,0] = numpy.clip(X[:,:,0], 0, height - 1)
-        out = frame[X[..., 0], X[..., 1]]
-        out[:,mask_diff,:] = 0
-        out[mask_above] = 0
-        out[mask_below] = 0
-        return out
+        opened = diff > 0
+        start = numpy.where(opened, imin, 4 * height).astype(numpy.float32)
+        scale = numpy.where(opened, height / numpy.maximum(diff, 1), 1).astype(numpy.float32)
+        return start, scale
 
     def process(self, input_file: utils.InputFile) -> pathlib.Path:
         output_path = self.inflate(input_file.path, {
@@ -131,9 +134,25 @@ class Squeeze(OneToOneTool):
             "duplication": self.duplication,
         })
         with utils.VideoInput(input_file.path) as vin:
-            with utils.VideoOutput(output_path, vin.width, vin.height, vin.framerate * self.duplication, vin.length * self.duplication, hide_progress=self.quiet) as vout:
-                for input_frame_index, inframe in enumerate(vin):
-                    for duplication_index in range(self.duplication):
-                        outframe = self.squeeze(inframe, vin.length, input_frame_index, duplication_index, vin.width, vin.height)
+            width, height = vin.width, vin.height
+            output_length = vin.length * self.duplication
+            rows = numpy.arange(height, dtype=numpy.float32)[:, numpy.newaxis]
+            map_x = numpy.tile(numpy.arange(width, dtype=numpy.float32), (height, 1))
+            map_y = numpy.empty((height, width), dtype=numpy.float32)
+            outframe = numpy.empty((height, width, 3), dtype=numpy.uint8)
+            start = scale = numpy.empty((0, width), dtype=numpy.float32)
+            t = 0
+            with utils.VideoOutput(output_path, width, height, vin.framerate * self.duplication, output_length, hide_progress=self.quiet) as vout:
+                for inframe in vin:
+                    for _ in range(self.duplication):
+                        k = t % self.CHUNK_SIZE
+                        if k == 0:
+                            start, scale = self.warp_parameters(numpy.arange(t, t + self.CHUNK_SIZE), output_length, width, height)
+                        numpy.subtract(rows, start[k], out=map_y)
+                        numpy.multiply(map_y, scale[k], out=map_y)
+                        numpy.floor(map_y, out=map_y)
+                        cv2.remap(inframe, map_x, map_y, cv2.INTER_NEAREST, dst=outframe,
+                            borderMode=cv2.BORDER_CONSTANT, borderValue=0)
                         vout.feed(outframe)
+                        t += 1
         return output_path
@@ -0,0 +1,50 @@
+import argparse
+import time
+
+from ..tool import Tool
+from .. import utils
+
+
+class Warmup(Tool):
+
+    NAME = "warmup"
+    DESC = "Compile the numba kernels used by other tools and store them in "\
+        "numba's on-disk cache (see NUMBA_CACHE_DIR), so that later calls do "\
+        "not pay for just-in-time compilation."
+
+    @staticmethod
+    def add_arguments(parser: argparse.ArgumentParser):
+        parser.add_argument("-Q", "--quiet", action="store_true",
+            help="do not print anything")
+
+    @classmethod
+    def run_from_args(cls, args: argparse.Namespace):
+        cls(**vars(args)).run()
+
+    def run(self):
+        for name, step in [("carving", self.warmup_carving), ("blending", self.warmup_blending)]:
+            time_start = time.time()
+            step()
+            if not self.quiet:
+                print(f"Compiled {name} kernels in {time.time() - time_start:.1f}s")
+
+    @staticmethod
+    def warmup_carving():
+        # Carving kernels have explicit signatures: importing compiles them
+        from .. import carving
+
+    @staticmethod
+    def warmup_blending():
+        import numpy
+        from .. import kernels
+        frames = numpy.zeros((2, 2, 2, 3), dtype=numpy.uint8)
+        for opname in ["average", "brighter", "darker", "sum", "difference", "weight1", "random", "median"]:
+            utils.getop(opname)(frames)
+        accumulator = utils.getaccumulator("random")
+        for frame in frames:
+            accumulator.add(frame)
+        rows = frames[0].reshape(2, -1)
+        for dtype in [numpy.uint16, numpy.uint32]:
+            histogram = numpy.zeros((*rows.shape, 256), dtype=dtype)
+            kernels.histogram_add(histogram, rows)
+            kernels.histogram_percentile(histogram, 1, 50.0, numpy.empty_like(rows))
@@ -1,3 +1,4 @@
+import argparse
 import contextlib
 import dataclasses
 import glob
@@ -216,6 +217,101 @@ def ffprobe(path: pathlib.Path, ffprobe="ffprobe") -> FFProbeResult:
     return FFProbeResult(width, height, framerate, duration, size, creation)
 
 
+def probe_packets(path: pathlib.Path, ffprobe="ffprobe") -> list[tuple[int, float, bool]]:
+    """Timestamp (in stream time base and in seconds) and keyframe flag of
+    the packets of the first video stream, in presentation order. Only
+    packet headers are read, frames are not decoded.
+    """
+    cmd = [
+        ffprobe,
+        "-v",
+        "quiet",
+        "-print_format",
+        "json",
+        "-select_streams",
+        "v:0",
+        "-show_entries",
+        "packet=pts,pts_time,flags",
+        path
+    ]
+    stdout = subprocess.check_output(cmd)
+    data = json.loads(stdout)
+    return sorted(
+        (int(packet["pts"]), float(packet["pts_time"]), "K" in packet.get("flags", ""))
+        for packet in data.get("packets", [])
+        if "pts" in packet and "pts_time" in packet)
+
+
+def keyframes(path: pathlib.Path, ffprobe="ffprobe") -> list[int]:
+    """Indices of the keyframes of the first video stream, in presentation
+    order.
+    """
+    return [i for i, (_, _, key) in enumerate(probe_packets(path, ffprobe)) if key]
+
+
+def fingerprint(path: pathlib.Path) -> str:
+    """Cheap identifier of a file's content, based on its size and
+    modification time.
+    """
+    stat = path.stat()
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def sidecar_path(input_path: pathlib.Path, suffix: str) -> pathlib.Path:
+    """Path of a file derived from an input, stored next to it. The suffix
+    is appended to the full name, so that inputs differing only by their
+    extension get distinct sidecars.
+    """
+    return input_path.with_name(input_path.name + suffix)
+
+
+def read_sidecar(path: pathlib.Path, input_path: pathlib.Path, parameters: dict | None = None) -> dict | None:
+    """Content of a sidecar file (.npz or .json), if it was computed from the
+    current version of `input_path` with the given `parameters` (any if
+    None), otherwise None.
+    """
+    if not path.exists():
+        return None
+    if path.suffix == ".npz":
+        import numpy
+        with numpy.load(path) as data:
+            content = {key: data[key] for key in data.files}
+        content["fingerprint"] = str(content["fingerprint"])
+        content["parameters"] = json.loads(str(content["parameters"]))
+    else:
+        with path.open("r", encoding="utf8") as file:
+            content = json.load(file)
+    if content.get("fingerprint") != fingerprint(input_path):
+        return None
+    if parameters is not None and content.get("parameters") != json.loads(json.dumps(parameters)):
+        return None
+    return content
+
+
+def load_sidecar(
+        path: pathlib.Path,
+        input_path: pathlib.Path,
+        parameters: dict,
+        compute: typing.Callable[[], dict]
+        ) -> dict:
+    """Content of a sidecar file, computed and saved again if it is missing
+    or outdated. `compute` returns a dict of arrays for .npz files, or of
+    JSON values for .json files; the input fingerprint and the parameters
+    are stored along with it.
+    """
+    content = read_sidecar(path, input_path, parameters)
+    if content is not None:
+        return content
+    content = {"fingerprint": fingerprint(input_path), "parameters": parameters, **compute()}
+    if path.suffix == ".npz":
+        import numpy
+        numpy.savez_compressed(path, **{**content, "parameters": json.dumps(parameters)})
+    else:
+        with path.open("w", encoding="utf8") as file:
+            json.dump(content, file, indent=1)
+    return content
+
+
 def find_unique_path(base_path: pathlib.Path) -> pathlib.Path:
     path = pathlib.Path(base_path)
     while path.exists():
@@ -291,7 +387,7 @@ def parse_bytes(string: str | None) -> int | None:
         "k": 1000,
         "m": 1000000,
         "g": 1000000000,
-    }[m.group(3)]
+    }[m.group(3) and m.group(3).lower()]
     return int(base * factor)
 
 
@@ -445,7 +541,7 @@ class VideoOutput:
     def feed(self, frame):
         import numpy
         assert self.process.stdin is not None
-        self.process.stdin.write(frame.astype(numpy.uint8).tobytes())
+        self.process.stdin.write(frame.astype(numpy.uint8, copy=False).tobytes())
         if self.pbar is not None:
             self.pbar.update(1)
             self.pbar.set_postfix({"time": format_timestamp(self.pbar.n / self.framerate)}, refresh=False)
@@ -469,36 +565,111 @@ def gauss(n: int, sigma: float, normalized: bool = False) -> list[float]:
     return [w/total for w in weights]
 
 
+def stack_reducer(kernel: typing.Callable, fallback: typing.Callable) -> typing.Callable:
+    """Wrap a compiled kernel from the `kernels` module into a blending
+    operation. The returned function takes a stack of frames and an optional
+    preallocated output array. Stacks that are not uint8 are processed by the
+    (slower) `fallback` numpy implementation.
+    """
+    import numpy
+    def aux(frames, out=None):
+        if frames.dtype != numpy.uint8:
+            result = fallback(frames)
+            if out is None:
+                return result
+            out[...] = numpy.clip(result, 0, 255)
+            return out
+        if out is None:
+            out = numpy.empty(frames.shape[1:], dtype=numpy.uint8)
+        kernel(frames.reshape(frames.shape[0], -1), out.reshape(-1))
+        return out
+    return aux
+
+
 def weighted_sum(sigma: float) -> typing.Callable:
     import numpy
-    def aux(frames):
+    from . import kernels
+    def fallback(frames):
         n = frames.shape[0]
         weights = numpy.reshape(gauss(n, sigma, True), (n, 1, 1, 1))
         return numpy.sum(numpy.multiply(weights, frames), axis=0)
+    def kernel(stack, out):
+        kernels.reduce_weighted(stack, numpy.array(gauss(stack.shape[0], sigma, True)), out)
+    return stack_reducer(kernel, fallback)
+
+
+def percentile_blend(q: float) -> typing.Callable:
+    import numpy
+    from . import kernels
+    def kernel(stack, out):
+        kernels.reduce_percentile(stack, q, out)
+    return stack_reducer(kernel, lambda a: numpy.percentile(a, q, axis=0))
+
+
+def parse_percentile(opname: str) -> float:
+    try:
+        q = float(opname.split(":", 1)[1])
+    except ValueError:
+        raise ValueError(f"Illegal operation '{opname}'")
+    if not 0 <= q <= 100:
+        raise ValueError(f"Percentile must be between 0 and 100, got {q}")
+    return q
+
+
+def operation_type(choices: list[str]) -> typing.Callable[[str], str]:
+    """Argparse type for blending operations: one of `choices`, or
+    `percentile:<p>` with p between 0 and 100.
+    """
+    def aux(string: str) -> str:
+        if string in choices:
+            return string
+        if string.startswith("percentile:"):
+            try:
+                parse_percentile(string)
+                return string
+            except ValueError as err:
+                raise argparse.ArgumentTypeError(str(err))
+        raise argparse.ArgumentTypeError(f"invalid choice: '{string}' (choose from {', '.join(choices)}, percentile:<p>)")
     return aux
 
 
-def random_blend(frames):
+def as_pixel_rows(array, leading: int = 0):
+    """View an array of frames of shape (..., height, width[, channels]) as
+    (..., pixels, channels), with the `leading` first axes left untouched.
+    """
+    shape = array.shape[leading:]
+    channels = shape[2] if len(shape) > 2 else 1
+    return array.reshape(*array.shape[:leading], shape[0] * shape[1], channels)
+
+
+def random_blend(frames, out=None):
     import numpy
-    n, height, width, depth = frames.shape
-    indices = numpy.random.randint(0, n, (height, width))
-    row_indices, col_indices = numpy.meshgrid(numpy.arange(height), numpy.arange(width), indexing="ij")
-    return frames[indices, row_indices, col_indices, :]
+    from . import kernels
+    if out is None:
+        out = numpy.empty(frames.shape[1:], dtype=frames.dtype)
+    kernels.gather_random(as_pixel_rows(numpy.ascontiguousarray(frames), 1), as_pixel_rows(out))
+    return out
 
 
 def getop(opname: str) -> typing.Callable:
+    """Return a blending operation, ie. a function taking a stack of frames of
+    shape (n, height, width, channels) and an optional preallocated uint8
+    output array of shape (height, width, channels), and returning the blended
+    frame. Arithmetic saturates to [0, 255] for 8-bit inputs.
+    """
     import numpy
+    from . import kernels
     match opname:
         case "average":
-            return lambda a: numpy.average(a, axis=0)
+            return stack_reducer(kernels.reduce_average, lambda a: numpy.average(a, axis=0))
         case "brighter":
-            return lambda a: numpy.max(a, axis=0)
+            return stack_reducer(kernels.reduce_brighter, lambda a: numpy.max(a, axis=0))
         case "darker":
-            return lambda a: numpy.min(a, axis=0)
+            return stack_reducer(kernels.reduce_darker, lambda a: numpy.min(a, axis=0))
         case "sum":
-            return lambda a: numpy.sum(a, axis=0)
+            return stack_reducer(kernels.reduce_sum, lambda a: numpy.sum(a, axis=0))
         case "difference":
-            return lambda a: a[0] - numpy.sum(a[1:], axis=0)
+            return stack_reducer(kernels.reduce_difference, lambda a: a[0] - numpy.sum(a[1:], axis=0))
         case "weight1":
             return weighted_sum(1)
         case "weight3":
@@ -509,5 +680,140 @@ def getop(opname: str) -> typing.Callable:
             return weighted_sum(10)
         case "random":
             return random_blend
+        case "median":
+            return percentile_blend(50.0)
+        case _ if opname.startswith("percentile:"):
+            return percentile_blend(parse_percentile(opname))
         case _:
             raise ValueError(f"Illegal operation '{opname}'")
+
+
+class Accumulator:
+    """Streaming counterpart of a blending operation: frames are added one at
+    a time and the blended frame is computed with `result`.
+    """
+
+    def add(self, frame):
+        raise NotImplementedError()
+
+    def result(self, out=None):
+        raise NotImplementedError()
+
+
+class StackAccumulator(Accumulator):
+    """Fallback for operations requiring the whole stack of frames at once."""
+
+    def __init__(self, operation: typing.Callable):
+        self.operation = operation
+        self.frames = []
+
+    def add(self, frame):
+        self.frames.append(frame)
+
+    def result(self, out=None):
+        import numpy
+        if not self.frames:
+            raise RuntimeError("No frame to blend")
+        return self.operation(numpy.array(self.frames), out)
+
+
+class ReservoirAccumulator(Accumulator):
+    """Random blending with a memory footprint of a single frame."""
+
+    def __init__(self):
+        self.current = None
+        self.count = 0
+
+    def add(self, frame):
+        import numpy
+        from . import kernels
+        self.count += 1
+        if self.current is None:
+            self.current = numpy.array(frame)
+            return
+        if frame.shape != self.current.shape:
+            raise ValueError(f"Frame shape {frame.shape} does not match {self.current.shape}")
+        kernels.reservoir_update(
+            as_pixel_rows(self.current),
+            as_pixel_rows(numpy.ascontiguousarray(frame, dtype=self.current.dtype)),
+            self.count)
+
+    def result(self, out=None):
+        if self.current is None:
+            raise RuntimeError("No frame to blend")
+        if out is None:
+            return self.current
+        out[...] = self.current
+        return out
+
+
+class PercentileAccumulator(Accumulator):
+    """Exact percentile of 8-bit frames in a single pass. Frames are stacked
+    until they weigh as much as per-value histograms of 256 uint16 counters,
+    they are then folded into such histograms in which later frames are
+    counted, so that memory stays bounded regardless of the number of frames.
+    """
+
+    MAX_STACK_SIZE = 512
+
+    def __init__(self, q: float):
+        self.q = q
+        self.frames = []
+        self.histogram = None
+        self.shape = None
+        self.count = 0
+
+    def _rows(self, frame):
+        return frame.reshape(frame.shape[0], -1)
+
+    def _fold(self, frame):
+        import numpy
+        from . import kernels
+        assert self.histogram is not None
+        if self.count >= numpy.iinfo(self.histogram.dtype).max:
+            self.histogram = self.histogram.astype(numpy.uint32)
+        kernels.histogram_add(self.histogram, self._rows(numpy.ascontiguousarray(frame)))
+        self.count += 1
+
+    def add(self, frame):
+        import numpy
+        if self.shape is None:
+            self.shape = frame.shape
+        elif frame.shape != self.shape:
+            raise ValueError(f"Frame shape {frame.shape} does not match {self.shape}")
+        if self.histogram is None:
+            self.frames.append(frame)
+            if len(self.frames) < self.MAX_STACK_SIZE or frame.dtype != numpy.uint8:
+                return
+            self.histogram = numpy.zeros((*self._rows(frame).shape, 256), dtype=numpy.uint16)
+            for stacked in self.frames:
+                self._fold(stacked)
+            self.frames = []
+        elif frame.dtype != numpy.uint8:
+            raise ValueError("Percentile blending requires 8-bit frames")
+        else:
+            self._fold(frame)
+
+    def result(self, out=None):
+        import numpy
+        from . import kernels
+        if self.histogram is None:
+            if not self.frames:
+                raise RuntimeError("No frame to blend")
+            return percentile_blend(self.q)(numpy.array(self.frames), out)
+        if out is None:
+            out = numpy.empty(self.shape, dtype=numpy.uint8)
+        kernels.histogram_percentile(self.histogram, self.count, self.q, self._rows(out))
+        return out
+
+
+def getaccumulator(opname: str) -> Accumulator:
+    match opname:
+        case "random":
+            return ReservoirAccumulator()
+        case "median":
+            return PercentileAccumulator(50.0)
+        case _ if opname.startswith("percentile:"):
+            return PercentileAccumulator(parse_percentile(opname))
+        case _:
+            return StackAccumulator(getop(opname))
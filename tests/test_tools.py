@@ -78,12 +78,24 @@ class TestTools(unittest.TestCase):
     
     def test_blend_images(self):
         self._test_many_to_one_tool(fftools.tools.BlendImages, False)
+
+    def test_blend_images_median(self):
+        self._test_many_to_one_tool(fftools.tools.BlendImages, False, operation="median")
         
     def test_blend_videos(self):
         self._test_many_to_one_tool(fftools.tools.BlendVideos, True)
+
+    def test_blend_videos_fan_in(self):
+        self._test_many_to_one_tool(fftools.tools.BlendVideos, True, fan_in=2)
     
     def test_carve(self):
         self._test_one_to_one_tool(fftools.tools.Carve, False, width=self.WIDTH-1, height=self.HEIGHT+1)
+
+    def test_carve_seam_map(self):
+        self._test_one_to_one_tool(fftools.tools.Carve, False, width=self.WIDTH-1, height=self.HEIGHT+1, seam_map=True)
+
+    def test_carve_video(self):
+        self._test_one_to_one_tool(fftools.tools.Carve, True, width=self.WIDTH-2, height=self.HEIGHT+2)
     
     def test_cut(self):
         for video in [True, False]:
@@ -99,6 +111,14 @@ class TestTools(unittest.TestCase):
         for video in [True, False]:
             self._test_one_to_one_tool(fftools.tools.Modulate, video, "outer", 0.5)
 
+    def test_modulate_spatial(self):
+        from fftools.tools.modulate import filter_frames
+        frames = numpy.random.default_rng(0).integers(0, 256, (2, 36, 64, 3), dtype=numpy.uint8)
+        for method, alpha in [("scale", 0.5), ("outer", 0.05), ("inner", 0.05), ("inner", 0.95)]:
+            expected = filter_frames(frames, method, alpha, spatial=False).astype(int)
+            actual = filter_frames(frames, method, alpha).astype(int)
+            self.assertLessEqual(numpy.abs(actual - expected).max(), 1)
+
     def test_preview(self):
         self._test_one_to_one_tool(fftools.tools.Preview, True, nrows=2, ncols=2)
     
@@ -113,11 +133,50 @@ class TestTools(unittest.TestCase):
     
     def test_retime_panorama(self):
         self._test_one_to_one_tool(fftools.tools.RetimePanorama, True, 1)
+
+    def test_retime_panorama_phase(self):
+        self._test_one_to_one_tool(fftools.tools.RetimePanorama, True, 1, motion="phase")
+
+    def test_retime_panorama_cache(self):
+        from fftools.tools.retime_panorama import motion_path
+        tool = fftools.tools.RetimePanorama(fftools.tools.RetimePanorama.OUTPUT_PATH_TEMPLATE, 1, motion="phase", analyse_only=True)
+        tool.quiet = True
+        self.assertIsNone(tool.process(self.input_video))
+        self.assertTrue(motion_path(self.input_video.path).exists())
+        self._test_one_to_one_tool(fftools.tools.RetimePanorama, True, 2, motion="phase", render_only=True)
+        with self.assertRaises(ValueError):
+            self._test_one_to_one_tool(fftools.tools.RetimePanorama, True, 2, render_only=True)
+
+    def test_retime_panorama_chunks(self):
+        from fftools.tools.retime_panorama import analyse_chunk, chunk_bounds
+        bounds = chunk_bounds(self.DURATION, 2, [])
+        self.assertEqual(bounds, [0, 2, self.DURATION - 1])
+        chunks = [analyse_chunk(self.input_video.path, "phase", a, b + 1) for a, b in zip(bounds, bounds[1:])]
+        dx = numpy.concatenate([chunk[0] for chunk in chunks])
+        self.assertEqual(len(dx), self.DURATION - 1)
     
     def test_scenes(self):
         path = self._test_one_to_one_tool(fftools.tools.Scenes, True, bin_width=1)
         self.assertTrue(path.is_dir())
-    
+
+    def test_scenes_all_frames(self):
+        from fftools.tools.scenes import load_scene_index
+        path = self._test_one_to_one_tool(fftools.tools.Scenes, True, all_frames=True, min_length=1)
+        self.assertTrue(path.is_dir())
+        index = load_scene_index(self.input_video.path)
+        assert index is not None
+        self.assertEqual(index["frames"], self.DURATION)
+        self.assertEqual(index["scenes"][0]["frame"], 0)
+    
+    def test_similar(self):
+        from fftools.hashing import HashLibrary
+        index_path = self.folder / "hashes.npz"
+        fftools.tools.Similar(index_path.as_posix(), [self.input_image.path.as_posix(), self.input_video.path.as_posix()], jobs=1, quiet=True).run()
+        library = HashLibrary.load(index_path)
+        self.assertEqual(len(library.files), 2)
+        image_hash = int(library.files[self.input_image.path.absolute().as_posix()][2][0])
+        self.assertIn((0, self.input_image.path.absolute().as_posix(), 0), library.search(image_hash, 0))
+
     def test_split(self):
         path = self._test_one_to_one_tool(fftools.tools.Split, True, duration="00:00:01")
         self.assertTrue(path.is_dir())
@@ -131,6 +190,9 @@ class TestTools(unittest.TestCase):
     def test_timestamp(self):
         self._test_one_to_one_tool(fftools.tools.Timestamp, True)
 
+    def test_warmup(self):
+        fftools.tools.Warmup(quiet=True).run()
+
     def test_run(self):
         fftools.tools.Resize((self.folder / "_test_run.png").as_posix(), width=16).run(self.input_image.path)
         fftools.tools.Stack(True, False, 1, 2).run([self.input_image.path, self.input_image.path], self.folder / "_test_run.png")